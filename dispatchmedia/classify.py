@@ -1,9 +1,11 @@
 # Copyright 2010 Quantique. Licence: GPL3+
 
 from . import media_types as MT
+from . import ops
 from . import torrents
-from .common import unix_basename, ensure_dir
-from .xmlrpc2scgi import do_xmlrpc
+from . import verify
+from .common import unix_basename, memoized_property, STAT_CACHE
+from .xmlrpc2scgi import do_xmlrpc, do_xmlrpc_iter
 
 from collections import defaultdict
 import logging
@@ -11,6 +13,11 @@ import os.path
 import subprocess
 import re
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 LOGGER = logging.getLogger(__name__)
 
 # Nonnegative decimal SP filename NL
@@ -110,7 +117,7 @@ class Release(object):
 
     @classmethod
     def from_fname(cls, fname):
-        if os.path.isdir(fname):
+        if STAT_CACHE.isdir(fname):
             return Directory(fname)
         real_ext, cl_ext = ext_of_name(fname)
         if cl_ext == '.torrent':
@@ -126,12 +133,13 @@ class Torrent(Release):
     def __init__(self, *args, **kargs):
         super(Torrent, self).__init__(*args, **kargs)
         self._data = torrents.from_filename(self.fname).as_torrent()
+        self._data.compact()
 
     def iter_names_and_sizes(self):
         return self._data.torrent_files()
 
     def walk_lockstep(self, down_loc, dest_parent):
-        if not os.path.exists(down_loc):
+        if not STAT_CACHE.exists(down_loc):
             LOGGER.warning('Skipping inexistent torrent root %s', down_loc)
             return
 
@@ -140,33 +148,35 @@ class Torrent(Release):
             yield down_loc, dest_loc
             return
 
+        table = self._data.file_table
         dirs_done = set()
-        ensure_dir(dest_loc)
-
-        for path_bytes in self._data.multi_finfo:
-            path_chars = self._data.multi_finfo_path(path_bytes)
-            src = os.path.join(down_loc, *path_chars)
-            if not os.path.exists(src):
+        ops.current().ensure_dir(dest_loc)
+        src_dirs = [os.path.join(down_loc, *dir_path)
+                    for dir_path in table.dirs]
+        dest_dirs = [os.path.join(dest_loc, *dir_path)
+                     for dir_path in table.dirs]
+
+        for (dir_id, name, length) in table:
+            src = os.path.join(src_dirs[dir_id], name)
+            if not STAT_CACHE.exists(src):
                 LOGGER.debug('Skipping inexistent torrent entry %s', src)
                 continue
-            dest = os.path.join(dest_loc, *path_chars)
-            dir_path = path_chars[:-1]
-            if tuple(dir_path) not in dirs_done:
+            if dir_id not in dirs_done:
                 pfx = dest_loc
-                pfx2 = []
-                for fragment in dir_path:
+                for fragment in table.dirs[dir_id]:
                     pfx += '/' + fragment
-                    pfx2.append(fragment)
-                    pfx3 = tuple(pfx2)
-                    if pfx3 not in dirs_done:
-                        ensure_dir(pfx)
-                        dirs_done.add(pfx3)
-            yield src, dest
+                    ops.current().ensure_dir(pfx)
+                dirs_done.add(dir_id)
+            yield src, os.path.join(dest_dirs[dir_id], name)
 
     @property
     def likely_down_name(self):
         return self._data.name
 
+    def verify_payload(self, down_loc, cache, processes=None):
+        return verify.verify_payload(
+                self._data, down_loc, cache, processes=processes)
+
 
 class RTorrentTorrent(Release):
     is_indirect = True
@@ -182,7 +192,7 @@ class RTorrentTorrent(Release):
         (self.name, ), (self.is_multi, ) = resps
 
     def iter_names_and_sizes(self):
-        resps = do_xmlrpc(
+        resps = do_xmlrpc_iter(
             self.endpoint, 'f.multicall',
             self.info_hash, '', 'f.path=', 'f.size_bytes=')
         for resp in resps:
@@ -190,8 +200,22 @@ class RTorrentTorrent(Release):
             # XXX prepend name, but only in some cases, non-multi is dicier
             yield path, length
 
-    def walk_lockstep(self, down_loc, dest_parent):
-        if not os.path.exists(down_loc):
+    def iter_completed_files(self):
+        """
+        Yield (index, path) for the files that are fully downloaded,
+        in a torrent that may not be.
+        """
+
+        resps = do_xmlrpc_iter(
+            self.endpoint, 'f.multicall', self.info_hash, '',
+            'f.path=', 'f.completed_chunks=', 'f.size_chunks=')
+        for (index, (path, completed, size)) in enumerate(resps):
+            if completed == size:
+                yield index, path
+
+    def walk_lockstep(self, down_loc, dest_parent, only=None):
+        # only: paths to restrict a multi-file torrent to
+        if not STAT_CACHE.exists(down_loc):
             LOGGER.warning('Skipping inexistent torrent root %s', down_loc)
             return
         dest_loc = os.path.join(dest_parent, self.name)
@@ -199,10 +223,12 @@ class RTorrentTorrent(Release):
             yield down_loc, dest_loc
             return
         dirs_done = set()
-        ensure_dir(dest_loc)
+        ops.current().ensure_dir(dest_loc)
         for (path, length) in self.iter_names_and_sizes():
+            if only is not None and path not in only:
+                continue
             src = os.path.join(down_loc, path)
-            if not os.path.exists(src):
+            if not STAT_CACHE.exists(src):
                 LOGGER.debug('Skipping inexistent torrent entry %s', src)
                 continue
             entry_dest_dir = os.path.dirname(path)
@@ -216,11 +242,11 @@ class RTorrentTorrent(Release):
                     else:
                         pfx2 = fragment
                     if pfx2 not in dirs_done:
-                        ensure_dir(pfx)
+                        ops.current().ensure_dir(pfx)
                         dirs_done.add(pfx2)
 
             dest = os.path.join(dest_loc, path)
-            ensure_dir(os.path.dirname(dest))
+            ops.current().ensure_dir(os.path.dirname(dest))
             yield src, dest
 
 
@@ -231,6 +257,11 @@ class TransmissionTorrent(Torrent):
 
     @property
     def transmission_basename(self):
+        # Transmission names resume files after the file it keeps in
+        # torrents/, which saves re-encoding the info dict for the hash.
+        fname = unix_basename(self.fname)
+        if fname.endswith('.torrent'):
+            return fname[:-len('.torrent')]
         # Are slashes even allowed? name should probably require no slashes.
         name = self._data.name.replace('/', '_')
         short_ih = self._data.info_hash[:16]
@@ -241,19 +272,65 @@ class TransmissionTorrent(Torrent):
         return os.path.join(self.config_dir, 'resume',
                 self.transmission_basename + '.resume')
 
+    @memoized_property
+    def transmission_resume(self):
+        return torrents.from_filename(self.transmission_resume_fname)
+
     @property
     def transmission_down_dir(self):
-        resume_data = torrents.from_file(self.transmission_resume_fname)
         # XXX Not sure about encoding
-        ddir = resume_data._tdata['destination'].decode('utf-8')
-        del resume_data
-        return ddir
+        return self.transmission_resume._tdata['destination'].decode('utf-8')
 
     @property
     def transmission_down_loc(self):
         return os.path.join(self.transmission_down_dir, self._data.name)
 
 
+class TransmissionRPCTorrent(Release):
+    """A torrent as described by Transmission's torrent-get."""
+
+    is_indirect = True
+
+    def __init__(self, tinfo):
+        super(TransmissionRPCTorrent, self).__init__(
+            tinfo['name'], name=tinfo['name'])
+        self.info_hash = tinfo['hashString']
+        self.down_dir = tinfo['downloadDir']
+        # File names are relative to downloadDir, name included
+        self._files = tinfo['files']
+
+    def iter_names_and_sizes(self):
+        for finfo in self._files:
+            yield finfo['name'], finfo['length']
+
+    @property
+    def down_loc(self):
+        return os.path.join(self.down_dir, self.name)
+
+    def walk_lockstep(self, down_loc, dest_parent):
+        if not STAT_CACHE.exists(down_loc):
+            LOGGER.warning('Skipping inexistent torrent root %s', down_loc)
+            return
+        if len(self._files) == 1 and self._files[0]['name'] == self.name:
+            yield down_loc, os.path.join(dest_parent, self.name)
+            return
+        dirs_done = set()
+        for finfo in self._files:
+            path = finfo['name']
+            src = os.path.join(self.down_dir, path)
+            if not STAT_CACHE.exists(src):
+                LOGGER.debug('Skipping inexistent torrent entry %s', src)
+                continue
+            entry_dest_dir = os.path.dirname(path)
+            if entry_dest_dir not in dirs_done:
+                pfx = dest_parent
+                for fragment in entry_dest_dir.split('/'):
+                    pfx += '/' + fragment
+                    ops.current().ensure_dir(pfx)
+                dirs_done.add(entry_dest_dir)
+            yield src, os.path.join(dest_parent, path)
+
+
 class Directory(Release):
     is_indirect = False
 
@@ -279,14 +356,14 @@ class Directory(Release):
                 d2 = os.path.join(dest_loc, os.path.relpath(dirpath, down_loc))
             # Happens when transitioning from shallow symlinks,
             # maybe we should error out anyway.
-            if os.path.lexists(d2):
-                if not os.path.isdir(d2):
+            if STAT_CACHE.lexists(d2):
+                if not STAT_CACHE.isdir(d2):
                     LOGGER.warning('%s already exists and isn\'t a directory', d2)
                     # Prevent recursion
                     dirnames[:] = []
                     continue
             else:
-                os.mkdir(d2)
+                ops.current().ensure_dir(d2)
             for fname in filenames:
                 src = os.path.join(dirpath, fname)
                 dest = os.path.join(d2, fname)
@@ -349,10 +426,20 @@ class Archive(Release):
             return self._iter_7z()
 
 
-def classify(release):
+def classify(release, facts=None):
+    """
+    Return the media type of release.
+
+    If facts is a dict, it is filled with what the decision was based on:
+    the dominant extension, its share of the total size, the total size
+    and the number of files.
+    """
+
     size_max = -1
     ext_size_max = -1
+    ext_size_max_item = None
     total_size = 0
+    file_count = 0
     # Keys are either empty or start with a dot.
     size_by_ext = defaultdict(int)
     item_count_by_ext = defaultdict(int)
@@ -365,6 +452,7 @@ def classify(release):
             common_prefix = fname
         size = int(size)
         total_size += size
+        file_count += 1
         if size > size_max:
             size_max = size
             size_max_item = fname
@@ -384,11 +472,29 @@ def classify(release):
 
         size_of_dir[dirname] += size
 
+    return _decide(
+        release, facts, total_size, file_count, size_max,
+        ext_size_max_item, ext_size_max, item_count_by_ext,
+        max(size_of_dir.values(), default=0), common_prefix)
+
+
+def _decide(release, facts, total_size, file_count, size_max,
+            ext_size_max_item, ext_size_max, item_count_by_ext,
+            largest_dir_size, common_prefix):
+    # The rules, once a listing has been reduced to these aggregates.
+    # Shared by classify and BatchClassifier.
+
+    if facts is not None:
+        if total_size > 0:
+            facts.update(
+                extension=ext_size_max_item[1:],
+                share=float(ext_size_max) / total_size)
+        facts.update(size=total_size, files=file_count)
+
     if size_max <= 0:  # No files or empty files
         return MT.Empty
 
-    largest_dir = max(size_of_dir, key=lambda d: size_of_dir[d])
-    largest_dir_rel_weight = float(size_of_dir[largest_dir]) / total_size
+    largest_dir_rel_weight = float(largest_dir_size) / total_size
 
     if not ext_size_max_item:
         LOGGER.warning('The bulk of the release has no file extension.')
@@ -396,7 +502,7 @@ def classify(release):
         return MT.Unknown
 
     ext_of_bulk = ext_size_max_item[1:]
-    count_of_bulk_by_ext = item_count_by_ext[ext_size_max_item]
+    count_of_bulk_by_ext = item_count_by_ext.get(ext_size_max_item, 0)
 
     LOGGER.info(
             'Extension %s, with %d file(s), accounts for %.1f%% of total size',
@@ -428,7 +534,8 @@ def classify(release):
     elif (ext_of_bulk in ISO_EXTS
           or (
               ext_of_bulk == 'bin'
-              and item_count_by_ext['.cue'] == item_count_by_ext['.bin'])):
+              and item_count_by_ext.get('.cue', 0)
+                  == item_count_by_ext.get('.bin', 0))):
         platform_hints = intersect_keepcase(GAME_PLATFORMS, release_tokens)
         if len(platform_hints) == 1:
             return MT.Media.registry[platform_hints.pop()]
@@ -463,3 +570,135 @@ def classify(release):
             'Report a bug if you think it should be')
         return MT.Unknown
 
+
+# Every extension the rules know about, so that ids are stable
+# and the table rarely grows during a run.
+KNOWN_EXTS = sorted(set.union(
+    MUSIC_EXTS, VID_EXTS, FONT_EXTS, ISO_EXTS, COMICBOOK_EXTS, EBOOK_EXTS,
+    GALLERY_EXTS, PACKAGE_EXTS, ARCHIVE_EXTS, AMBIGUOUS_EXTS, {'cue'}))
+
+
+class BatchClassifier(object):
+    """
+    classify, for many releases or very long listings.
+
+    Listings become arrays of extension ids and sizes, which are
+    aggregated with numpy. Extensions are mapped to ids through a
+    table that is kept across releases, so ext_of_name only runs once
+    per distinct extension. The rules are the ones classify applies,
+    and so are the results, down to ties between extensions.
+    Without numpy, this is classify.
+    """
+
+    def __init__(self):
+        # Classification extensions, by id; '' is id 0
+        self._cl_exts = ['']
+        self._cl_ids = {'': 0}
+        for ext in KNOWN_EXTS:
+            self._cl_id('.' + ext)
+        # Raw extension, or (raw extension, after .tar), to id
+        self._ext_ids = {'': 0}
+
+    def _cl_id(self, cl_ext):
+        cl_id = self._cl_ids.get(cl_ext)
+        if cl_id is None:
+            cl_id = self._cl_ids[cl_ext] = len(self._cl_exts)
+            self._cl_exts.append(cl_ext)
+        return cl_id
+
+    def classify(self, release, facts=None):
+        if numpy is None:
+            return classify(release, facts)
+
+        ext_ids = self._ext_ids
+        dir_ids = {}
+        names = []
+        sizes = []
+        file_exts = []
+        file_dirs = []
+        # os.path.split and os.path.splitext, inlined; the exact
+        # results matter for the tie-breaking rules below.
+        for (fname, size) in release.iter_names_and_sizes():
+            names.append(fname)
+            sizes.append(int(size))
+            slash = fname.rfind('/') + 1
+            basename = fname[slash:]
+            if not basename:
+                # fname is empty or ends with a slash.
+                raise ValueError(fname)
+            dirname = fname[:slash]
+            if dirname:
+                dirname = dirname.rstrip('/') or dirname
+            dir_id = dir_ids.get(dirname)
+            if dir_id is None:
+                dir_id = dir_ids[dirname] = len(dir_ids)
+            file_dirs.append(dir_id)
+
+            dot = basename.rfind('.')
+            if dot > 0 and basename[:dot].lstrip('.'):
+                key = basename[dot:]
+                if key[1:] in TAR_COMPTYPES:
+                    key = (key, basename[:dot].endswith('.tar'))
+            else:
+                key = ''
+            ext_id = ext_ids.get(key)
+            if ext_id is None:
+                ext_id = ext_ids[key] = self._cl_id(ext_of_name(basename)[1])
+            file_exts.append(ext_id)
+
+        file_count = len(names)
+        if not file_count:
+            return _decide(release, facts, 0, 0, -1, None, -1, {}, 0, None)
+
+        sizes = numpy.array(sizes, dtype=numpy.int64)
+        file_exts = numpy.array(file_exts, dtype=numpy.intp)
+        file_dirs = numpy.array(file_dirs, dtype=numpy.intp)
+        # Float sums are exact up to 2**53 bytes
+        size_by_ext = numpy.bincount(
+            file_exts, weights=sizes).astype(numpy.int64)
+        count_by_ext = numpy.bincount(file_exts)
+        size_of_dir = numpy.bincount(file_dirs, weights=sizes)
+
+        ext_size_max = size_by_ext.max()
+        bulk = numpy.flatnonzero(size_by_ext == ext_size_max)
+        if len(bulk) > 1:
+            # classify keeps the extension that reached the largest
+            # size first, that is whose last nonempty file comes first.
+            last = numpy.full(len(size_by_ext), -1, numpy.intp)
+            nonempty = numpy.flatnonzero(sizes > 0)
+            numpy.maximum.at(last, file_exts[nonempty], nonempty)
+            if ext_size_max > 0:
+                bulk = bulk[numpy.argmin(last[bulk])]
+            else:
+                # All empty; the first file's extension
+                bulk = file_exts[0]
+        else:
+            bulk = bulk[0]
+
+        present = numpy.flatnonzero(count_by_ext)
+        item_count_by_ext = dict(
+            (self._cl_exts[cl_id], int(count_by_ext[cl_id]))
+            for cl_id in present)
+
+        return _decide(
+            release, facts, int(sizes.sum()), file_count, int(sizes.max()),
+            self._cl_exts[bulk], int(ext_size_max), item_count_by_ext,
+            int(size_of_dir.max()), os.path.commonprefix(names))
+
+
+def classify_many(releases, facts=None):
+    """
+    The media type of each release, in order.
+
+    If facts is a list, a facts dict per release is appended to it.
+    """
+
+    classifier = BatchClassifier()
+    types = []
+    for release in releases:
+        if facts is not None:
+            facts.append({})
+            types.append(classifier.classify(release, facts[-1]))
+        else:
+            types.append(classifier.classify(release))
+    return types
@@ -5,6 +5,8 @@ import os.path
 import stat
 import time
 
+from . import metrics
+
 
 def iso8601_now():
     # http://www.aczoom.com/blog/ac/2007-02-24/strftime-in-python
@@ -29,8 +31,124 @@ def unix_basename(path):
         return os.path.basename(di)
 
 
+class StatCache(object):
+    """
+    stat and lstat results for the duration of a run.
+
+    Each path goes to the filesystem once, missing paths included.
+    Our own operations forget the paths they change; changes made
+    by others during the run go unnoticed. Lookups answered from
+    the cache are counted in the run metrics.
+    """
+
+    def __init__(self):
+        # (path, follow_symlinks): stat_result, or None if missing
+        self._entries = {}
+        # Normalized path: the paths it was looked up as
+        self._spellings = {}
+        # Normalized path: normalized paths of its cached descendants,
+        # or of their ancestors, one level down
+        self._children = {}
+
+    def _get(self, path, follow):
+        key = (path, follow)
+        if key in self._entries:
+            metrics.add('stat_cache.saved_syscalls')
+            return self._entries[key]
+        try:
+            st = os.stat(path) if follow else os.lstat(path)
+        except OSError:
+            st = None
+        self._entries[key] = st
+        self._index(path)
+        return st
+
+    def _index(self, path):
+        norm = os.path.normpath(path)
+        self._spellings.setdefault(norm, set()).add(path)
+        while True:
+            parent = os.path.dirname(norm)
+            if parent == norm:
+                break
+            siblings = self._children.setdefault(parent, set())
+            if norm in siblings:
+                # So are its ancestors
+                break
+            siblings.add(norm)
+            norm = parent
+
+    def stat(self, path):
+        return self._get(path, True)
+
+    def lstat(self, path):
+        return self._get(path, False)
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def lexists(self, path):
+        return self.lstat(path) is not None
+
+    def isdir(self, path):
+        st = self.stat(path)
+        return st is not None and stat.S_ISDIR(st.st_mode)
+
+    def islink(self, path):
+        st = self.lstat(path)
+        return st is not None and stat.S_ISLNK(st.st_mode)
+
+    def samefile(self, path1, path2):
+        st1 = self.stat(path1)
+        st2 = self.stat(path2)
+        return (st1 is not None and st2 is not None
+                and (st1.st_dev, st1.st_ino) == (st2.st_dev, st2.st_ino))
+
+    def _drop(self, norm):
+        for path in self._spellings.pop(norm, ()):
+            self._entries.pop((path, True), None)
+            self._entries.pop((path, False), None)
+
+    def forget(self, path, tree=False):
+        """
+        Drop path, and with tree, everything under it.
+
+        Only the cached part of the tree is walked.
+        """
+
+        path = os.path.normpath(path)
+        self._drop(path)
+        if tree:
+            todo = list(self._children.pop(path, ()))
+            while todo:
+                norm = todo.pop()
+                self._drop(norm)
+                todo.extend(self._children.pop(norm, ()))
+
+    def forget_parents(self, path):
+        """Drop path and its ancestors, after creating them."""
+
+        path = os.path.normpath(path)
+        while True:
+            self._drop(path)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
+    def clear(self):
+        self._entries.clear()
+        self._spellings.clear()
+        self._children.clear()
+
+
+# Shared by everything that looks at paths during a run
+STAT_CACHE = StatCache()
+
+
 def ensure_dir(path, allow_link=True):
     # Make sure a directory exists
+    if allow_link and STAT_CACHE.isdir(path):
+        return
     try:
         os.mkdir(path)
     except OSError as e:
@@ -46,6 +164,8 @@ def ensure_dir(path, allow_link=True):
             st = os.lstat(path)
         if not stat.S_ISDIR(st.st_mode):
             raise
+    else:
+        STAT_CACHE.forget(path)
 
 
 # From SQLalchemy; MIT licence
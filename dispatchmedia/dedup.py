@@ -0,0 +1,285 @@
+# Copyright 2010 Quantique. Licence: GPL3+
+
+"""
+A content index of the media library, to avoid storing things twice.
+
+Files are keyed by size and a partial hash of their first, middle and
+last blocks, which is cheap to compute. Files that share a key are
+only considered identical once their full hashes match; full hashes
+are computed on demand and remembered.
+
+Rows remember the inode, size and mtime they were hashed at, and are
+dropped or rehashed when the file has changed since.
+"""
+
+import errno
+import fcntl
+import hashlib
+import logging
+import multiprocessing
+import os
+import os.path
+import stat
+
+LOGGER = logging.getLogger(__name__)
+
+BLOCK_SIZE = 64 * 1024
+# Smaller files aren't worth the bookkeeping
+MIN_SIZE = BLOCK_SIZE
+READ_SIZE = 1024 * 1024
+# Rows written per transaction by reindex(), so that other
+# processes don't wait on the database for the whole run
+REINDEX_BATCH = 256
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+MODES = ('hardlink', 'reflink')
+
+
+def partial_hash(path, size):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fhandle:
+        if size <= 3 * BLOCK_SIZE:
+            sha.update(fhandle.read())
+        else:
+            for offset in (0, (size - BLOCK_SIZE) // 2, size - BLOCK_SIZE):
+                fhandle.seek(offset)
+                sha.update(fhandle.read(BLOCK_SIZE))
+    return sha.digest()
+
+
+def full_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fhandle:
+        while True:
+            data = fhandle.read(READ_SIZE)
+            if not data:
+                break
+            sha.update(data)
+    return sha.digest()
+
+
+def clone_file(orig, dest, mode):
+    """
+    Make dest a hardlink or a reflink of orig.
+
+    Returns False if the filesystem can't do it, in which case
+    dest hasn't been created.
+    """
+
+    if mode == 'hardlink':
+        try:
+            os.link(orig, dest)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            return False
+        return True
+
+    with open(orig, 'rb') as src:
+        with open(dest, 'xb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP,
+                                   errno.EINVAL, errno.ENOTTY):
+                    raise
+                cloned = False
+            else:
+                cloned = True
+    if not cloned:
+        os.unlink(dest)
+        return False
+    st = os.stat(orig)
+    os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.chmod(dest, stat.S_IMODE(st.st_mode))
+    return True
+
+
+def _hash_entry(entry):
+    # Pool worker
+    path, sig = entry
+    try:
+        return path, sig, partial_hash(path, sig[1])
+    except OSError as e:
+        LOGGER.warning('Can\'t read %s: %s', path, e)
+        return path, sig, None
+
+
+def iter_files(root):
+    """Yield (path, (ino, size, mtime_ns)) for regular files under root."""
+
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_size >= MIN_SIZE:
+                yield path, (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class DedupIndex(object):
+    def __init__(self, store, mode='hardlink'):
+        if mode not in MODES:
+            raise ValueError(mode)
+        self._store = store
+        self.mode = mode
+        with store.transaction() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS library ('
+                ' path TEXT PRIMARY KEY, ino INTEGER, size INTEGER,'
+                ' mtime INTEGER, partial BLOB, full BLOB)')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS library_key'
+                ' ON library (size, partial)')
+
+    @property
+    def _conn(self):
+        return self._store.connection
+
+    def _put(self, path, sig, partial):
+        ino, size, mtime = sig
+        self._conn.execute(
+            'INSERT OR REPLACE INTO library VALUES (?, ?, ?, ?, ?, NULL)',
+            (path, ino, size, mtime, partial))
+
+    def _put_many(self, entries):
+        # The write lock is only held while writing, not while hashing
+        if not entries:
+            return
+        with self._store.transaction():
+            for (path, sig, partial) in entries:
+                self._put(path, sig, partial)
+
+    def add(self, path):
+        """Index path, or every file under it if it is a directory."""
+
+        if os.path.isdir(path) and not os.path.islink(path):
+            entries = iter_files(path)
+        else:
+            try:
+                st = os.lstat(path)
+            except OSError:
+                return
+            if not stat.S_ISREG(st.st_mode) or st.st_size < MIN_SIZE:
+                return
+            entries = [(path, (st.st_ino, st.st_size, st.st_mtime_ns))]
+        for (path, sig) in entries:
+            try:
+                partial = partial_hash(path, sig[1])
+            except OSError as e:
+                LOGGER.warning('Can\'t index %s: %s', path, e)
+                continue
+            self._put(path, sig, partial)
+
+    def remove(self, path):
+        self._conn.execute('DELETE FROM library WHERE path = ?', (path, ))
+
+    def lookup(self, path):
+        """
+        Find a library file with the same contents as path.
+
+        Returns its path, or None.
+        """
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if not stat.S_ISREG(st.st_mode) or st.st_size < MIN_SIZE:
+            return
+        partial = partial_hash(path, st.st_size)
+        candidates = self._conn.execute(
+            'SELECT path, ino, mtime, full FROM library'
+            ' WHERE size = ? AND partial = ?',
+            (st.st_size, partial)).fetchall()
+        digest = None
+        for (cand, ino, mtime, cand_digest) in candidates:
+            try:
+                cst = os.lstat(cand)
+            except OSError:
+                self.remove(cand)
+                continue
+            if (cst.st_ino, cst.st_size, cst.st_mtime_ns) != (
+                    ino, st.st_size, mtime):
+                # Changed behind our back; it gets a fresh row
+                # next time it is added or reindexed.
+                self.remove(cand)
+                continue
+            if (cst.st_dev, cst.st_ino) == (st.st_dev, st.st_ino):
+                return cand
+            if cand_digest is None:
+                cand_digest = full_hash(cand)
+                self._conn.execute(
+                    'UPDATE library SET full = ? WHERE path = ?',
+                    (cand_digest, cand))
+            if digest is None:
+                digest = full_hash(path)
+            if digest == cand_digest:
+                return cand
+
+    def place(self, orig, dest):
+        """
+        Create dest from an identical library file, if there is one.
+
+        Returns True if dest was created.
+        """
+
+        match = self.lookup(orig)
+        if match is None:
+            return False
+        if not clone_file(match, dest, self.mode):
+            LOGGER.debug('Can\'t %s %s to %s', self.mode, match, dest)
+            return False
+        LOGGER.info('%s is a duplicate of %s, %s it',
+                dest, match, self.mode + 'ed')
+        self.add(dest)
+        return True
+
+    def reindex(self, roots, processes=None):
+        """
+        Bring the index up to date with the files under roots.
+
+        Only new and changed files are hashed, in a process pool.
+        """
+
+        known = {}
+        for (path, ino, size, mtime) in self._conn.execute(
+                'SELECT path, ino, size, mtime FROM library'):
+            known[path] = (ino, size, mtime)
+
+        seen = set()
+        todo = []
+        for root in roots:
+            for (path, sig) in iter_files(root):
+                seen.add(path)
+                if known.get(path) != sig:
+                    todo.append((path, sig))
+
+        prefixes = tuple(os.path.join(root, '') for root in roots)
+        gone = [path for path in known
+                if path.startswith(prefixes) and path not in seen]
+        with self._store.transaction():
+            for path in gone:
+                self.remove(path)
+
+        LOGGER.info('Hashing %d new or changed files, forgetting %d',
+                len(todo), len(gone))
+        pool = multiprocessing.Pool(processes)
+        try:
+            batch = []
+            for (path, sig, partial) in pool.imap_unordered(
+                    _hash_entry, todo, chunksize=16):
+                if partial is not None:
+                    batch.append((path, sig, partial))
+                if len(batch) >= REINDEX_BATCH:
+                    self._put_many(batch)
+                    batch = []
+            self._put_many(batch)
+        finally:
+            pool.terminate()
+            pool.join()
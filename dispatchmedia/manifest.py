@@ -0,0 +1,127 @@
+# Copyright 2010 Quantique. Licence: GPL3+
+
+"""
+Manifests of what was placed in the library, per release.
+
+A manifest lists every path an action created for a release under
+its destination, keyed by the release's source path. It lets later
+runs skip releases that are already in place, and lets --gc clean up
+after releases whose source is gone, without walking the library.
+"""
+
+import collections
+import logging
+import marshal
+import os
+import os.path
+
+LOGGER = logging.getLogger(__name__)
+
+# Kinds of placed paths. Only symlinks and directories are ever
+# cleaned up; files are copies or hardlinks and outlive their source.
+DIR = 'dir'
+SYMLINK = 'symlink'
+FILE = 'file'
+
+Manifest = collections.namedtuple(
+    'Manifest', 'action dest_parent source_sig paths')
+
+
+def source_sig(source):
+    try:
+        st = os.lstat(source)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns)
+
+
+def with_parents(dest_parent, placed):
+    """
+    Add the directories between dest_parent and the placed paths.
+
+    Returns a sorted list of (path, kind); paths outside dest_parent
+    are left out.
+    """
+
+    prefix = os.path.join(dest_parent, '')
+    paths = {}
+    for (path, kind) in placed:
+        path = os.path.normpath(path)
+        if not path.startswith(prefix):
+            continue
+        paths[path] = kind
+        parent = os.path.dirname(path)
+        while parent.startswith(prefix):
+            paths[parent] = DIR
+            parent = os.path.dirname(parent)
+    return sorted(paths.items())
+
+
+class Manifests(object):
+    def __init__(self, store):
+        self._db = store.db('manifests')
+
+    def get(self, source):
+        blob = self._db.get(source)
+        if blob is None:
+            return None
+        return Manifest(*marshal.loads(blob))
+
+    def put(self, source, action, dest_parent, paths):
+        self._db[source] = marshal.dumps(
+            (action, dest_parent, source_sig(source),
+             [tuple(entry) for entry in paths]))
+
+    def remove(self, source):
+        del self._db[source]
+
+    def sources(self):
+        return [os.fsdecode(key) for key in self._db.keys()]
+
+    def is_complete(self, source, action, dest_parent):
+        """
+        Whether action already placed source in dest_parent.
+
+        Only the source itself and the top-level destination paths
+        are looked at, not every file.
+        """
+
+        manifest = self.get(source)
+        if manifest is None:
+            return False
+        if (manifest.action, manifest.dest_parent) != (action, dest_parent):
+            return False
+        if manifest.source_sig != source_sig(source):
+            return False
+        tops = [path for (path, kind) in manifest.paths
+                if os.path.dirname(path) == dest_parent]
+        return bool(tops) and all(os.path.lexists(path) for path in tops)
+
+
+def collect_garbage(manifests, executor):
+    """
+    Remove what was placed for releases whose source is gone.
+
+    Broken symlinks are removed, then the directories that are left
+    empty, deepest first. Everything else stays.
+    """
+
+    count = 0
+    for source in manifests.sources():
+        if os.path.lexists(source):
+            continue
+        manifest = manifests.get(source)
+        LOGGER.info('Cleaning up after %s', source)
+        executor.begin_item(source)
+        dirs = []
+        for (path, kind) in manifest.paths:
+            if kind == SYMLINK:
+                executor.remove_link(path)
+            elif kind == DIR:
+                dirs.append(path)
+        dirs.sort(key=lambda path: path.count(os.path.sep), reverse=True)
+        for path in dirs:
+            executor.remove_dir(path)
+        executor.forget_manifest(source)
+        count += 1
+    return count
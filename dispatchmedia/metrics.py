@@ -0,0 +1,47 @@
+# Copyright 2010 Quantique. Licence: GPL3+
+
+"""
+Counters and timings for the current run, logged when it ends.
+
+Names are dotted, grouped by what they measure; timings are seconds
+and end in _seconds.
+"""
+
+import collections
+import contextlib
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+_counters = collections.Counter()
+
+
+def add(name, value=1):
+    _counters[name] += value
+
+
+def get(name):
+    return _counters[name]
+
+
+@contextlib.contextmanager
+def timer(name):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        add(name, time.monotonic() - started)
+
+
+def reset():
+    _counters.clear()
+
+
+def report():
+    for name in sorted(_counters):
+        value = _counters[name]
+        if name.endswith('_seconds'):
+            LOGGER.info('%s: %.1f', name, value)
+        else:
+            LOGGER.info('%s: %d', name, value)
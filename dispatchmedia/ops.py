@@ -0,0 +1,698 @@
+# Copyright 2010 Quantique. Licence: GPL3+
+
+"""
+Filesystem operations performed by dispatch actions.
+
+Actions don't touch the library directly, they go through the current
+executor. Executor performs operations right away. Planner only
+records them into a Plan, which can be optimized, saved for review,
+and applied later in one batch.
+"""
+
+from . import metrics
+from . import throttle
+from .common import ensure_dir, iso8601_now, memoized_property, STAT_CACHE
+from .manifest import Manifests, with_parents, DIR
+from .xmlrpc2scgi import do_xmlrpc, RPCError
+
+import base64
+import errno
+import functools
+import logging
+import os
+import os.path
+import shutil
+import subprocess
+import xmlrpc.client
+import yaml
+
+try:
+    import xattr
+except ImportError:
+    xattr = None
+
+try:
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Executor(object):
+    """Perform operations immediately."""
+
+    planning = False
+
+    def __init__(self, store=None, dedup=None):
+        self.store = store
+        # A DedupIndex of the library, or None
+        self.dedup = dedup
+        # The throttle.IOLimit of the current source, or None
+        self.io_limit = None
+        # Limits replayed from a plan, by setting
+        self._plan_limits = {}
+
+    def begin_item(self, key):
+        pass
+
+    def set_io_limit(self, limit):
+        self.io_limit = limit
+
+    def _limit(self, io_limit):
+        # Planned operations carry the io-limit setting of their source
+        if io_limit is None:
+            return self.io_limit
+        key = repr(sorted(io_limit.items()))
+        if key not in self._plan_limits:
+            self._plan_limits[key] = throttle.IOLimit.from_config(io_limit)
+        return self._plan_limits[key]
+
+    def _io_slot(self, limit):
+        if self.store is None:
+            return throttle.Slot(None, None)
+        return throttle.Slot(limit, os.path.join(self.store.path, 'locks'))
+
+    def makedirs(self, path, mode=0o700):
+        LOGGER.info('Creating %s', path)
+        os.makedirs(path, mode=mode, exist_ok=True)
+        STAT_CACHE.forget_parents(path)
+
+    def ensure_dir(self, path):
+        ensure_dir(path)
+
+    def ensure_dirs(self, path):
+        os.makedirs(path, exist_ok=True)
+        STAT_CACHE.forget_parents(path)
+
+    def _link_in_place(self, orig, dest, orig_rel):
+        # Whether dest already links to orig; None if nothing is there.
+        # orig_rel is the symlink target, None for hardlinks.
+        if orig_rel is not None:
+            # The samefile test won't work for broken yet correct symlinks
+            if STAT_CACHE.islink(dest) and os.readlink(dest) == orig_rel:
+                return True
+
+        if STAT_CACHE.lexists(dest):
+            if not STAT_CACHE.exists(dest):
+                LOGGER.warning(
+                        '%s already exists and is a broken symlink, skipping',
+                        dest)
+            elif not STAT_CACHE.samefile(orig, dest):
+                LOGGER.warning(
+                        '%s already exists and doesn\'t point to %s %s %s,'
+                        ' skipping',
+                        dest, orig, orig_rel, orig_rel is not None)
+            else:
+                return True
+            return False
+        return None
+
+    def link_once(self, orig, dest, symbolic):
+        """
+        Link dest to orig, unless something else is there.
+
+        Returns True if dest is now the link, whether it was created
+        or already in place.
+        """
+
+        if symbolic:
+            orig_rel = os.path.relpath(orig, os.path.dirname(dest))
+        else:
+            orig_rel = None
+
+        in_place = self._link_in_place(orig, dest, orig_rel)
+        if in_place is not None:
+            return in_place
+
+        STAT_CACHE.forget(dest)
+        try:
+            if symbolic:
+                os.symlink(orig_rel, dest)
+            elif self.dedup is not None and self.dedup.place(orig, dest):
+                pass
+            else:
+                try:
+                    os.link(orig, dest)
+                except OSError as e:
+                    if e.errno != errno.EPERM:
+                        raise
+                    # chattr +i prevents hardlinking, sadly
+                    LOGGER.warning('%s linking %s to %s',
+                            e.strerror, orig, dest)
+                    return False
+                if self.dedup is not None:
+                    self.dedup.add(dest)
+        except FileExistsError:
+            # Another worker got there after we looked
+            STAT_CACHE.forget(dest)
+            return bool(self._link_in_place(orig, dest, orig_rel))
+        return True
+
+    def move(self, orig, dest, io_limit=None):
+        if os.path.lexists(dest):
+            LOGGER.warning(
+                    '%s already exists, skipping move of %s',
+                    dest, orig)
+            return
+        limit = self._limit(io_limit)
+        STAT_CACHE.forget(orig, tree=True)
+        STAT_CACHE.forget(dest, tree=True)
+        # Only copies when moving across filesystems
+        with self._io_slot(limit):
+            shutil.move(orig, dest, copy_function=functools.partial(
+                throttle.copy_file, limit=limit))
+        if self.dedup is not None:
+            self.dedup.add(dest)
+
+    def _rsync(self, limit, args, input=None):
+        cmd = ['rsync', '-ax'] + throttle.rsync_options(limit) + args
+        with self._io_slot(limit), metrics.timer('io.rsync_seconds'):
+            subprocess.run(cmd, input=input, check=True,
+                    **throttle.subprocess_kwargs(limit))
+
+    def rsync(self, orig, dest, io_limit=None):
+        limit = self._limit(io_limit)
+        STAT_CACHE.forget(dest, tree=True)
+        if self.dedup is None:
+            # DWIM workaround
+            if os.path.isdir(orig):
+                orig += '/'
+            self._rsync(limit, ['--', orig, dest, ])
+            return
+
+        entries = list(rsync_entries(orig, dest))
+        # Files already in the library are linked in place first;
+        # rsync is only given what is left.
+        left = []
+        placed = False
+        for (rel, src, target) in entries:
+            if (os.path.isfile(src) and not os.path.islink(src)
+                    and not os.path.lexists(target)):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if self.dedup.place(src, target):
+                    placed = True
+                    continue
+            left.append(rel)
+
+        if not os.path.isdir(orig):
+            if not placed:
+                self._rsync(limit, ['--', orig, dest, ])
+        elif not placed:
+            self._rsync(limit, ['--', os.path.join(orig, ''), dest, ])
+        else:
+            # -R is implied, and -r isn't; directories are listed
+            # so that they are created even when empty.
+            self._rsync(limit,
+                ['--from0', '--files-from=-', '--',
+                 os.path.join(orig, ''), dest, ],
+                input=b'\0'.join(os.fsencode(rel) for rel in left))
+
+        for (rel, src, target) in entries:
+            if not os.path.isdir(src):
+                self.dedup.add(target)
+
+    def extract(self, archive_path, dest_parent, log_path, moves,
+            io_limit=None):
+        """
+        Extract archive_path with dtrx, log where, then do the moves.
+        """
+
+        # The log is only created on success
+        if os.path.exists(log_path):
+            LOGGER.info('Archive %s has already been extracted, skipping',
+                    archive_path)
+            return
+
+        # List the files so we know where they were extracted.
+        cmd = ['dtrx', '-nv', '--', os.path.abspath(archive_path), ]
+        limit = self._limit(io_limit)
+        with self._io_slot(limit), metrics.timer('io.extract_seconds'):
+            proc = subprocess.Popen(cmd,
+                    cwd=dest_parent, stdout=subprocess.PIPE, text=True,
+                    **throttle.subprocess_kwargs(limit))
+
+            line = next(proc.stdout)
+            dtrx_dest = os.path.normpath(line.rstrip())
+            if os.path.sep in dtrx_dest:
+                dtrx_dest = dtrx_dest[:dtrx_dest.index(os.path.sep)]
+            dtrx_dest = os.path.join(dest_parent, dtrx_dest)
+
+            proc.wait()
+        STAT_CACHE.forget(dtrx_dest, tree=True)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+        with open(log_path, 'a') as log:
+            yaml.dump(
+                    [{'extracted-to': dtrx_dest, 'date': iso8601_now(), }],
+                    log, default_flow_style=False)
+
+        for (src, dest) in moves:
+            ensure_dir(os.path.dirname(dest))
+            STAT_CACHE.forget(src)
+            STAT_CACHE.forget(dest)
+            os.rename(src, dest)
+
+        if self.dedup is not None:
+            self.dedup.add(dtrx_dest)
+        # Keyed by where the archive ends up, or --gc would take
+        # archives moved to extract-bak for releases that are gone
+        self.record_manifest(dict(moves).get(archive_path, archive_path),
+                'extract', dest_parent,
+                with_parents(dest_parent, [(dtrx_dest, DIR)]))
+
+    def relocate_torrents(self, endpoint, moves):
+        """
+        Move rtorrent downloads within a filesystem, and have rtorrent
+        seed them from there.
+
+        moves are (info_hash, orig, dest, directory_base, done_path,
+        done_key) lists. Torrents are stopped in one system.multicall,
+        renamed, pointed at directory_base in another, then started.
+        If a rename fails, it is logged, the renames before it are
+        undone and every torrent is started where it was. done_key is set on done_path
+        for each torrent that was moved.
+        """
+
+        free = []
+        for move in moves:
+            if os.path.lexists(move[2]):
+                LOGGER.warning('%s already exists, not relocating %s',
+                        move[2], move[1])
+            else:
+                free.append(move)
+        if not free:
+            return
+        faults = rtorrent_multicall(endpoint, [
+            (method, [move[0]])
+            for move in free for method in ('d.stop', 'd.close')])
+        moves = []
+        for (index, move) in enumerate(free):
+            fault = faults[2 * index] or faults[2 * index + 1]
+            if fault is None:
+                moves.append(move)
+                continue
+            LOGGER.error('Can\'t stop %s in rtorrent: %s', move[0], fault)
+            rtorrent_multicall(endpoint, [('d.start', [move[0]])])
+
+        renamed = []
+        try:
+            for move in moves:
+                (info_hash, orig, dest, dbase, dpath, dkey) = move
+                LOGGER.info('Relocating %s to %s', orig, dest)
+                STAT_CACHE.forget(orig, tree=True)
+                STAT_CACHE.forget(dest, tree=True)
+                os.rename(orig, dest)
+                renamed.append(move)
+        except OSError as e:
+            LOGGER.error('Can\'t relocate %s to %s: %s', orig, dest, e)
+            try:
+                for (info_hash, orig, dest, dbase, dpath, dkey
+                     ) in reversed(renamed):
+                    self._move_back(orig, dest)
+            finally:
+                rtorrent_multicall(endpoint, [
+                    ('d.start', [info_hash])
+                    for (info_hash, orig, dest, dbase, dpath, dkey
+                         ) in moves])
+            return
+
+        faults = rtorrent_multicall(endpoint, [
+            ('d.directory_base.set', [info_hash, dbase])
+            for (info_hash, orig, dest, dbase, dpath, dkey) in moves])
+        try:
+            for (move, fault) in zip(moves, faults):
+                (info_hash, orig, dest, dbase, dpath, dkey) = move
+                if fault is not None:
+                    # rtorrent still has the old location; move back there
+                    LOGGER.error('Can\'t relocate %s in rtorrent: %s',
+                            info_hash, fault)
+                    self._move_back(orig, dest)
+        finally:
+            rtorrent_multicall(endpoint, [
+                ('d.start', [info_hash])
+                for (info_hash, orig, dest, dbase, dpath, dkey) in moves])
+        for (move, fault) in zip(moves, faults):
+            (info_hash, orig, dest, dbase, dpath, dkey) = move
+            if fault is None:
+                if self.dedup is not None:
+                    self.dedup.add(dest)
+                self.set_xattr(dpath, dkey, b'ok')
+
+    def _move_back(self, orig, dest):
+        # Undo a relocation rename; on failure, the data stays at dest
+        # and someone has to move it back by hand.
+        STAT_CACHE.forget(orig, tree=True)
+        STAT_CACHE.forget(dest, tree=True)
+        try:
+            os.rename(dest, orig)
+        except OSError as e:
+            LOGGER.error('Can\'t move %s back to %s: %s', dest, orig, e)
+
+    def set_xattr(self, path, key, value):
+        try:
+            xattr.xattr(path).set(key.encode(), value)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                LOGGER.warning('%s doesn\'t exist, not marking it', path)
+            else:
+                raise
+
+    def mark(self, table, key, value=b'1'):
+        self.store.db(table)[key] = value
+
+    @memoized_property
+    def manifests(self):
+        return Manifests(self.store)
+
+    def record_manifest(self, source, action, dest_parent, paths):
+        self.manifests.put(source, action, dest_parent, paths)
+
+    def forget_manifest(self, source):
+        self.manifests.remove(source)
+
+    def remove_link(self, path):
+        # Only broken symlinks; anything else has been changed by hand
+        if os.path.islink(path) and not os.path.exists(path):
+            LOGGER.info('Removing %s', path)
+            STAT_CACHE.forget(path)
+            os.unlink(path)
+
+    def remove_dir(self, path):
+        STAT_CACHE.forget(path)
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.ENOENT, errno.ENOTDIR):
+                raise
+        else:
+            LOGGER.info('Removed empty directory %s', path)
+
+
+class Planner(Executor):
+    """Record operations into a plan, without touching anything."""
+
+    planning = True
+
+    def __init__(self, store=None):
+        super(Planner, self).__init__(store)
+        self.plan = Plan()
+        self._item = None
+        self._dirs = set()
+
+    def begin_item(self, key):
+        self._item = key
+
+    def _record(self, op, *args):
+        self.plan.add(op, args, self._item)
+
+    def _will_be_dir(self, path):
+        return path in self._dirs or STAT_CACHE.isdir(path)
+
+    def makedirs(self, path, mode=0o700):
+        if not self._will_be_dir(path):
+            self._dirs.add(path)
+            self._record('makedirs', path, mode)
+
+    def ensure_dir(self, path):
+        if not self._will_be_dir(path):
+            self._dirs.add(path)
+            self._record('ensure_dirs', path)
+
+    ensure_dirs = ensure_dir
+
+    def link_once(self, orig, dest, symbolic):
+        # Leave out links that are already in place.
+        # Conflicts are recorded, and warned about when applying,
+        # but won't be the link.
+        if STAT_CACHE.lexists(dest):
+            if symbolic and STAT_CACHE.islink(dest):
+                orig_rel = os.path.relpath(orig, os.path.dirname(dest))
+                if os.readlink(dest) == orig_rel:
+                    return True
+            elif STAT_CACHE.samefile(orig, dest):
+                return True
+            self._record('link_once', orig, dest, symbolic)
+            return False
+        self._record('link_once', orig, dest, symbolic)
+        return True
+
+    def _io_config(self):
+        # The setting, so that --apply throttles like a direct run
+        if self.io_limit is None:
+            return None
+        # A copy each time, or the plan would be full of YAML aliases
+        return dict(self.io_limit.config)
+
+    def move(self, orig, dest, io_limit=None):
+        self._record('move', orig, dest, self._io_config())
+
+    def rsync(self, orig, dest, io_limit=None):
+        self._record('rsync', orig, dest, self._io_config())
+
+    def extract(self, archive_path, dest_parent, log_path, moves,
+            io_limit=None):
+        if os.path.exists(log_path):
+            return
+        self._record('extract', archive_path, dest_parent, log_path,
+                [list(move) for move in moves], self._io_config())
+
+    def relocate_torrents(self, endpoint, moves):
+        self._record('relocate_torrents', endpoint,
+                [list(move) for move in moves])
+
+    def set_xattr(self, path, key, value):
+        self._record('set_xattr', path, key, value)
+
+    def mark(self, table, key, value=b'1'):
+        self._record('mark', table, key, value)
+
+    def record_manifest(self, source, action, dest_parent, paths):
+        self._record('record_manifest', source, action, dest_parent,
+                [list(entry) for entry in paths])
+
+    def forget_manifest(self, source):
+        self._record('forget_manifest', source)
+
+    def remove_link(self, path):
+        self._record('remove_link', path)
+
+    def remove_dir(self, path):
+        self._record('remove_dir', path)
+
+
+def rtorrent_multicall(endpoint, calls):
+    """
+    Make (method, params) calls in one system.multicall.
+
+    Returns the fault of each call, None for those that succeeded.
+    """
+
+    resps = do_xmlrpc(endpoint, 'system.multicall', [
+        dict(methodName=method, params=params)
+        for (method, params) in calls])
+    return [resp if isinstance(resp, dict) else None for resp in resps]
+
+
+def rsync_entries(orig, dest):
+    """
+    Yield (relative path, source, destination) for what
+    Executor.rsync copies from orig into dest.
+
+    Like rsync with a trailing slash, the contents of a directory
+    are copied, not the directory itself.
+    """
+
+    if not os.path.isdir(orig):
+        name = os.path.basename(orig)
+        yield name, orig, os.path.join(dest, name)
+        return
+    for (dirpath, dirnames, filenames) in os.walk(orig):
+        rel_dir = os.path.relpath(dirpath, orig)
+        yield rel_dir, dirpath, os.path.normpath(os.path.join(dest, rel_dir))
+        # Symlinks to directories aren't walked into; copy the links
+        names = [name for name in dirnames
+                 if os.path.islink(os.path.join(dirpath, name))]
+        names.extend(filenames)
+        for name in sorted(names):
+            rel = os.path.normpath(os.path.join(rel_dir, name))
+            yield rel, os.path.join(dirpath, name), os.path.join(dest, rel)
+
+
+# Operations are applied by phase:
+# directories, extractions, file placement and removal, directory
+# removal, then bookkeeping, which is skipped for items where
+# anything failed.
+PHASES = {
+    'makedirs': 0,
+    'ensure_dirs': 1,
+    'extract': 2,
+    'move': 3,
+    'relocate_torrents': 3,
+    'rsync': 3,
+    'link_once': 3,
+    'remove_link': 3,
+    'remove_dir': 4,
+    'set_xattr': 5,
+    'mark': 5,
+    'record_manifest': 5,
+    'forget_manifest': 5,
+    }
+BOOKKEEPING_PHASE = 5
+
+
+def nearest_dev(path, cache):
+    """st_dev of path, or of its closest existing ancestor."""
+
+    parent = os.path.dirname(path)
+    if parent in cache:
+        return cache[parent]
+    try:
+        dev = os.stat(parent).st_dev
+    except OSError:
+        if parent == path:
+            dev = -1
+        else:
+            dev = nearest_dev(parent, cache)
+    cache[parent] = dev
+    return dev
+
+
+# File names that aren't valid UTF-8 can't be YAML strings;
+# they are saved as the base64 of their bytes, with this tag.
+FSNAME_TAG = '!fsname'
+
+
+class PlanDumper(SafeDumper):
+    def represent_str(self, data):
+        try:
+            data.encode()
+        except UnicodeEncodeError:
+            return self.represent_scalar(FSNAME_TAG,
+                    base64.b64encode(os.fsencode(data)).decode('ascii'))
+        return super(PlanDumper, self).represent_str(data)
+
+
+PlanDumper.add_representer(str, PlanDumper.represent_str)
+
+
+class PlanLoader(SafeLoader):
+    def construct_fsname(self, node):
+        return os.fsdecode(base64.b64decode(self.construct_scalar(node)))
+
+
+PlanLoader.add_constructor(FSNAME_TAG, PlanLoader.construct_fsname)
+
+
+class Plan(object):
+    """
+    A list of operations, each tagged with the items it is done for.
+    """
+
+    def __init__(self, entries=()):
+        self.entries = list(entries)
+
+    def add(self, op, args, item):
+        self.entries.append(dict(op=op, args=list(args), items=[item]))
+
+    def optimize(self):
+        """
+        Deduplicate operations, coalesce directory creation,
+        and sort by phase, then device and destination directory.
+        """
+
+        # Deduplicate, merging the items
+        by_key = {}
+        entries = []
+        for entry in self.entries:
+            key = (entry['op'], repr(entry['args']))
+            if key in by_key:
+                merged = by_key[key]
+                for item in entry['items']:
+                    if item not in merged['items']:
+                        merged['items'].append(item)
+                continue
+            by_key[key] = entry
+            entries.append(entry)
+
+        # One makedirs for the deepest directory covers its ancestors
+        dirs = {}
+        for entry in entries:
+            if entry['op'] == 'ensure_dirs':
+                dirs[entry['args'][0]] = entry
+        for (path, entry) in sorted(dirs.items(), reverse=True):
+            parent = os.path.dirname(path)
+            while parent and parent != os.path.dirname(parent):
+                if parent in dirs:
+                    covered = dirs.pop(parent)
+                    for item in covered['items']:
+                        if item not in entry['items']:
+                            entry['items'].append(item)
+                parent = os.path.dirname(parent)
+        entries = [entry for entry in entries
+                   if entry['op'] != 'ensure_dirs'
+                   or dirs.get(entry['args'][0]) is entry]
+
+        devs = {}
+
+        def sort_key(entry):
+            op, args = entry['op'], entry['args']
+            phase = PHASES[op]
+            if op in ('makedirs', 'ensure_dirs', 'mark',
+                      'record_manifest', 'forget_manifest'):
+                return (phase, 0, str(args[0]), str(args[1:]))
+            if op in ('set_xattr', 'relocate_torrents'):
+                return (phase, 0, args[0], str(args[1]))
+            if op == 'remove_dir':
+                # Deepest first
+                return (phase, 0, -args[0].count(os.path.sep), args[0])
+            if op == 'remove_link':
+                return (phase, nearest_dev(args[0], devs),
+                        os.path.dirname(args[0]), os.path.basename(args[0]))
+            dest = args[1]
+            if op in ('move', 'rsync', 'extract'):
+                # dest is the parent directory
+                dest = os.path.join(dest, '')
+            return (phase, nearest_dev(dest, devs),
+                    os.path.dirname(dest), os.path.basename(dest))
+
+        # sort is stable, operations on the same path keep their order
+        entries.sort(key=sort_key)
+        self.entries = entries
+
+    def apply(self, executor):
+        failed = set()
+        for entry in self.entries:
+            op, args, items = entry['op'], entry['args'], entry['items']
+            if PHASES[op] == BOOKKEEPING_PHASE and failed.intersection(items):
+                continue
+            try:
+                getattr(executor, op)(*args)
+            except (OSError, subprocess.CalledProcessError,
+                    xmlrpc.client.Fault, RPCError) as e:
+                LOGGER.error('%s %s failed: %s', op, args, e)
+                failed.update(items)
+        return not failed
+
+    def dump(self, stream):
+        yaml.dump(self.entries, stream, Dumper=PlanDumper,
+                default_flow_style=None, allow_unicode=True,
+                sort_keys=False)
+
+    @classmethod
+    def load(cls, stream):
+        return cls(yaml.load(stream, Loader=PlanLoader) or ())
+
+
+# The executor actions go through, see set_current()
+_current = Executor()
+
+
+def current():
+    return _current
+
+
+def set_current(executor):
+    global _current
+    _current = executor
@@ -0,0 +1,289 @@
+# Copyright 2010 Quantique. Licence: GPL3+
+
+"""
+Tell whether a set of RAR volumes is complete, from headers alone.
+
+Only block headers are read; the data between them is skipped with
+a seek. A set is complete when every volume is whole, volumes are
+numbered in order, split files carry on from one volume to the next,
+and only the last volume's end of archive block says it is the last.
+Both the RAR 1.5-4.x and the RAR 5.0 formats are understood.
+
+Verdicts are cached per set, along with the size and mtime of every
+volume, so an incomplete set costs a stat per volume until it changes.
+"""
+
+import collections
+import logging
+import marshal
+import os
+import re
+import struct
+
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+RAR4_MARK = b'Rar!\x1a\x07\x00'
+RAR5_MARK = b'Rar!\x1a\x07\x01\x00'
+
+# RAR 1.5-4.x block types and flags
+RAR4_HEAD = struct.Struct('<HBHH')
+RAR4_MAIN = 0x73
+RAR4_FILE = 0x74
+RAR4_SUB = 0x7a
+RAR4_END = 0x7b
+RAR4_LONG_BLOCK = 0x8000
+RAR4_MAIN_VOLUME = 0x0001
+RAR4_MAIN_PASSWORD = 0x0080
+RAR4_FILE_SPLIT_BEFORE = 0x0001
+RAR4_FILE_SPLIT_AFTER = 0x0002
+RAR4_FILE_LARGE = 0x0100
+RAR4_END_NEXT_VOLUME = 0x0001
+RAR4_END_DATACRC = 0x0002
+RAR4_END_VOLNUMBER = 0x0008
+
+# RAR 5.0 header types and flags
+RAR5_MAIN = 1
+RAR5_FILE = 2
+RAR5_CRYPT = 4
+RAR5_END = 5
+RAR5_HAS_EXTRA = 0x0001
+RAR5_HAS_DATA = 0x0002
+RAR5_SPLIT_BEFORE = 0x0008
+RAR5_SPLIT_AFTER = 0x0010
+RAR5_MAIN_VOLUME = 0x0001
+RAR5_MAIN_VOLNUMBER = 0x0002
+RAR5_END_NOT_LAST = 0x0001
+
+PART_RE = re.compile(r'\.part(\d+)\.rar$', re.I)
+OLD_PART_RE = re.compile(r'\.r(\d\d)$', re.I)
+
+# number is 0-based, None if the headers don't say.
+# split_before and split_after are about the first and last files.
+Volume = collections.namedtuple('Volume',
+    'is_volume number has_end next_volume split_before split_after')
+
+
+class IncompleteVolume(Exception):
+    pass
+
+
+def volume_order(names):
+    """
+    Sort volume names: name.part1.rar, name.part2.rar...
+    or name.rar, name.r00, name.r01...
+    """
+
+    def key(name):
+        match = PART_RE.search(name)
+        if match:
+            return int(match.group(1)), name
+        match = OLD_PART_RE.search(name)
+        if match:
+            return int(match.group(1)), name
+        return -1, name
+
+    return sorted(names, key=key)
+
+
+def _read_exactly(fhandle, pos, count):
+    fhandle.seek(pos)
+    data = fhandle.read(count)
+    if len(data) < count:
+        raise IncompleteVolume('truncated header at offset %d' % pos)
+    return data
+
+
+def _vint(buf, offset):
+    # RAR 5.0 variable length integer: 7 bits per byte, low bits first
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(buf) or shift > 63:
+            raise IncompleteVolume('bad header')
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def _read_rar4(fhandle, size):
+    pos = len(RAR4_MARK)
+    is_volume = False
+    number = None
+    split_before = split_after = None
+    while pos < size:
+        head = _read_exactly(fhandle, pos, RAR4_HEAD.size)
+        _, htype, flags, hsize = RAR4_HEAD.unpack(head)
+        if hsize < RAR4_HEAD.size:
+            raise IncompleteVolume('bad header at offset %d' % pos)
+        body = _read_exactly(fhandle, pos + RAR4_HEAD.size,
+                             hsize - RAR4_HEAD.size)
+        data_size = 0
+        if flags & RAR4_LONG_BLOCK:
+            data_size = struct.unpack_from('<I', body)[0]
+            if htype in (RAR4_FILE, RAR4_SUB) and flags & RAR4_FILE_LARGE:
+                data_size |= struct.unpack_from('<I', body, 25)[0] << 32
+
+        if htype == RAR4_MAIN:
+            if flags & RAR4_MAIN_PASSWORD:
+                # Encrypted headers
+                return None
+            is_volume = bool(flags & RAR4_MAIN_VOLUME)
+        elif htype == RAR4_FILE:
+            if split_before is None:
+                split_before = bool(flags & RAR4_FILE_SPLIT_BEFORE)
+            split_after = bool(flags & RAR4_FILE_SPLIT_AFTER)
+        elif htype == RAR4_END:
+            if flags & RAR4_END_VOLNUMBER:
+                offset = 4 if flags & RAR4_END_DATACRC else 0
+                number = struct.unpack_from('<H', body, offset)[0]
+            return Volume(is_volume, number, True,
+                          bool(flags & RAR4_END_NEXT_VOLUME),
+                          bool(split_before), bool(split_after))
+
+        pos += hsize + data_size
+        if pos > size:
+            raise IncompleteVolume('truncated data at offset %d' % size)
+    # Archivers before 3.0 don't always write an end of archive block
+    return Volume(is_volume, number, False, None,
+                  bool(split_before), bool(split_after))
+
+
+def _read_rar5(fhandle, size):
+    pos = len(RAR5_MARK)
+    is_volume = False
+    number = None
+    split_before = split_after = None
+    while pos < size:
+        # CRC32, then the header size in at most 3 bytes
+        head = _read_exactly(fhandle, pos, min(7, size - pos))
+        if len(head) < 5:
+            raise IncompleteVolume('truncated header at offset %d' % pos)
+        hsize, offset = _vint(head, 4)
+        header = _read_exactly(fhandle, pos + offset, hsize)
+        htype, hoff = _vint(header, 0)
+        flags, hoff = _vint(header, hoff)
+        if flags & RAR5_HAS_EXTRA:
+            _, hoff = _vint(header, hoff)
+        data_size = 0
+        if flags & RAR5_HAS_DATA:
+            data_size, hoff = _vint(header, hoff)
+
+        if htype == RAR5_CRYPT:
+            # Encrypted headers
+            return None
+        elif htype == RAR5_MAIN:
+            aflags, hoff = _vint(header, hoff)
+            is_volume = bool(aflags & RAR5_MAIN_VOLUME)
+            if aflags & RAR5_MAIN_VOLNUMBER:
+                number, hoff = _vint(header, hoff)
+            elif is_volume:
+                # The first volume has no number
+                number = 0
+        elif htype == RAR5_FILE:
+            if split_before is None:
+                split_before = bool(flags & RAR5_SPLIT_BEFORE)
+            split_after = bool(flags & RAR5_SPLIT_AFTER)
+        elif htype == RAR5_END:
+            eflags, hoff = _vint(header, hoff)
+            return Volume(is_volume, number, True,
+                          bool(eflags & RAR5_END_NOT_LAST),
+                          bool(split_before), bool(split_after))
+
+        pos += offset + hsize + data_size
+        if pos > size:
+            raise IncompleteVolume('truncated data at offset %d' % size)
+    raise IncompleteVolume('no end of archive block')
+
+
+def read_volume(path):
+    """
+    Read the block headers of a RAR volume.
+
+    Returns a Volume, or None if the headers can't be read
+    (encrypted, or not a RAR file we know).
+    Raises IncompleteVolume if the volume is cut short.
+    """
+
+    with open(path, 'rb') as fhandle:
+        size = os.fstat(fhandle.fileno()).st_size
+        mark = fhandle.read(len(RAR5_MARK))
+        try:
+            if mark == RAR5_MARK:
+                return _read_rar5(fhandle, size)
+            if mark[:len(RAR4_MARK)] == RAR4_MARK:
+                return _read_rar4(fhandle, size)
+        except struct.error:
+            raise IncompleteVolume('bad header')
+        if not mark.strip(b'\0'):
+            # Empty, or preallocated and not written yet
+            raise IncompleteVolume('no data yet')
+        if len(mark) < len(RAR5_MARK) and RAR5_MARK.startswith(mark):
+            raise IncompleteVolume('truncated marker')
+        return None
+
+
+def check_volumes(paths):
+    """
+    Whether paths, in volume order, make a complete archive.
+
+    Returns (complete, reason). complete is None when the headers
+    don't tell, in which case extraction should go ahead.
+    """
+
+    prev = None
+    for (index, path) in enumerate(paths):
+        try:
+            vol = read_volume(path)
+        except IncompleteVolume as e:
+            return False, '%s: %s' % (path, e)
+        except OSError as e:
+            return False, str(e)
+        if vol is None:
+            return None, 'can\'t read the headers of %s' % path
+        if vol.number is not None and vol.number != index:
+            return False, '%s is volume %d, expected volume %d' % (
+                path, vol.number + 1, index + 1)
+        if index == 0 and vol.split_before:
+            return False, 'the volume before %s is missing' % path
+        if prev is not None and prev.split_after and not vol.split_before:
+            return False, 'a volume is missing before %s' % path
+        if not vol.has_end:
+            return None, 'no end of archive block in %s' % path
+        if not vol.next_volume:
+            if index < len(paths) - 1:
+                LOGGER.debug('Ignoring files after the last volume %s',
+                        path)
+            return True, None
+        prev = vol
+    return False, 'volumes after %s are missing' % paths[-1]
+
+
+class VolumeChecks(object):
+    """check_volumes, with verdicts cached in a state table."""
+
+    def __init__(self, db):
+        self._db = db
+
+    def check(self, key, paths):
+        sig = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                return False, str(e)
+            sig.append((path, st.st_size, st.st_mtime_ns))
+
+        blob = self._db.get(key)
+        if blob is not None:
+            cached_sig, complete, reason = marshal.loads(blob)
+            if cached_sig == sig:
+                metrics.add('rar.cached_checks')
+                return complete, reason
+        complete, reason = check_volumes(paths)
+        self._db[key] = marshal.dumps((sig, complete, reason))
+        return complete, reason
@@ -0,0 +1,217 @@
+# Copyright 2010 Quantique. Licence: GPL3+
+
+"""
+Persistent state kept between runs.
+
+Everything lives in a single sqlite database in the state directory,
+so that several dispatch-media processes can share it safely.
+It is split in tables that act like dbm files, one per concern,
+so that caches can be dropped individually.
+"""
+
+import contextlib
+import fnmatch
+import marshal
+import os
+import os.path
+import re
+import sqlite3
+import struct
+
+TABLE_NAME_RE = re.compile(r'^[a-z][a-z0-9_]*$')
+
+
+def as_key(key):
+    # Like dbm, accept both str and bytes keys. Keys are often
+    # file names, which needn't be valid UTF-8.
+    if isinstance(key, str):
+        return os.fsencode(key)
+    return key
+
+
+class Table(object):
+    """A dbm-like mapping stored in a table of the state database."""
+
+    def __init__(self, store, name):
+        self._store = store
+        self._name = name
+
+    def transaction(self):
+        return self._store.transaction()
+
+    def _execute(self, sql, params=()):
+        return self._store.connection.execute(
+            sql.replace('{table}', self._name), params)
+
+    def get(self, key, default=None):
+        row = self._execute('SELECT value FROM {table} WHERE key = ?',
+                (as_key(key), )).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        if isinstance(value, str):
+            value = os.fsencode(value)
+        self._execute('INSERT OR REPLACE INTO {table} VALUES (?, ?)',
+                (as_key(key), value))
+
+    def __delitem__(self, key):
+        self._execute('DELETE FROM {table} WHERE key = ?', (as_key(key), ))
+
+    def keys(self):
+        return [row[0] for row in self._execute('SELECT key FROM {table}')]
+
+
+class StateStore(object):
+    DB_NAME = 'state.sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._conn_pid = None
+        self._tables = {}
+
+    @property
+    def connection(self):
+        # Connections can't be shared with forked workers
+        if self._conn is None or self._conn_pid != os.getpid():
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            self._conn = sqlite3.connect(
+                os.path.join(self.path, self.DB_NAME),
+                timeout=60, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode = WAL')
+            self._conn.execute('PRAGMA synchronous = NORMAL')
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Hold the write lock; other processes wait for commit."""
+
+        conn = self.connection
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+
+    def db(self, name):
+        """Return the dbm-like table called name, creating it if needed."""
+
+        if name not in self._tables:
+            if not TABLE_NAME_RE.match(name):
+                raise ValueError(name)
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS %s'
+                ' (key BLOB PRIMARY KEY, value BLOB NOT NULL)' % name)
+            self._tables[name] = Table(self, name)
+        return self._tables[name]
+
+    def close(self):
+        if self._conn is not None and self._conn_pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+        self._tables.clear()
+
+
+# inode, size, mtime
+STAT_SIG = struct.Struct('<QQq')
+
+
+class StatSnapshot(object):
+    """
+    (inode, size, mtime) of the entries of a directory,
+    as of the last run.
+
+    changed() lists entries that are new or changed since then.
+    Entries are only carried to the next run once settle()d,
+    so that anything that couldn't be handled is looked at again.
+    Once every entry is settled, the directory's own mtime is kept
+    too, and the directory isn't even listed until it changes.
+    """
+
+    def __init__(self, db, key, readonly=False):
+        self._db = db
+        self._key = as_key(key)
+        self._readonly = readonly
+        blob = db.get(self._key)
+        if blob:
+            self._dir_mtime, self._old = marshal.loads(blob)
+        else:
+            self._dir_mtime, self._old = None, {}
+        self._current = {}
+        self._new = {}
+        self._scanned_mtime = None
+
+    def changed(self, dirpath, pattern='*'):
+        # Stat before listing, so that later changes aren't missed
+        dir_mtime = os.stat(dirpath).st_mtime_ns
+        if dir_mtime == self._dir_mtime:
+            self._current = dict(self._old)
+            self._new = dict(self._old)
+            self._scanned_mtime = dir_mtime
+            return []
+
+        # Like glob, hidden files must be asked for explicitly
+        match = re.compile(fnmatch.translate(pattern)).match
+        hidden = pattern.startswith('.')
+        names = []
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                if not match(entry.name):
+                    continue
+                if entry.name.startswith('.') and not hidden:
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    # Removed since the listing
+                    continue
+                sig = STAT_SIG.pack(st.st_ino, st.st_size, st.st_mtime_ns)
+                self._current[entry.name] = sig
+                if self._old.get(entry.name) == sig:
+                    self._new[entry.name] = sig
+                else:
+                    names.append(entry.name)
+        self._scanned_mtime = dir_mtime
+        return names
+
+    def mtime(self, name):
+        """mtime in seconds of an entry listed by changed()."""
+
+        return STAT_SIG.unpack(self._current[name])[2] / 1e9
+
+    def settle(self, name):
+        if name in self._current:
+            self._new[name] = self._current[name]
+
+    def save(self):
+        if self._readonly:
+            return
+        with self._db.transaction():
+            # Concurrent workers may have settled entries
+            # that this one saw claimed; keep them.
+            blob = self._db.get(self._key)
+            if blob:
+                other = marshal.loads(blob)[1]
+                for (name, sig) in self._current.items():
+                    if name not in self._new and other.get(name) == sig:
+                        self._new[name] = sig
+            if len(self._new) == len(self._current):
+                dir_mtime = self._scanned_mtime
+            else:
+                dir_mtime = None
+            self._db[self._key] = marshal.dumps((dir_mtime, self._new))
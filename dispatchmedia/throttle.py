@@ -0,0 +1,195 @@
+# Copyright 2010 Quantique. Licence: GPL3+
+
+"""
+Keep dispatching from starving the torrent client of disk bandwidth.
+
+A source's io-limit setting caps the copy rate, the number of copies
+and extractions running at once, and can put subprocesses in the idle
+I/O scheduling class. The time lost to throttling goes to the run
+metrics.
+"""
+
+import ctypes
+import fcntl
+import logging
+import os
+import os.path
+import platform
+import re
+import shutil
+import time
+
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+SIZE_RE = re.compile(r'^(\d+(?:\.\d+)?)\s*([KMG]?)i?B?$', re.I)
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+COPY_CHUNK = 1 << 20
+
+# From linux/ioprio.h
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+SYS_IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    }
+
+
+def parse_size(value):
+    """Bytes from an int or a string like 20M."""
+
+    if isinstance(value, int):
+        return value
+    match = SIZE_RE.match(str(value).strip())
+    if match is None:
+        raise ValueError('Invalid size %r' % value)
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit.upper()])
+
+
+class IOLimit(object):
+    def __init__(self, rate=None, concurrency=None, idle=False, config=None):
+        # The io-limit setting this came from
+        self.config = config
+        # Bytes per second, or None
+        self.rate = rate
+        # Operations at once, across processes, or None
+        self.concurrency = concurrency
+        self.idle = idle
+        if rate:
+            self.bucket = TokenBucket(rate)
+        else:
+            self.bucket = None
+
+    @classmethod
+    def from_config(cls, config):
+        """From a source's io-limit setting, which may be missing."""
+
+        if not config:
+            return None
+        rate = config.get('rate')
+        return cls(
+            rate=parse_size(rate) if rate else None,
+            concurrency=config.get('concurrency'),
+            idle=config.get('idle', True),
+            config=dict(config))
+
+
+class TokenBucket(object):
+    """Let through rate bytes per second, with bursts of one second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = rate
+        self._tokens = rate
+        self._stamp = time.monotonic()
+
+    def consume(self, count):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        self._tokens -= count
+        if self._tokens < 0:
+            delay = -self._tokens / self.rate
+            metrics.add('io.throttled_seconds', delay)
+            time.sleep(delay)
+
+
+class Slot(object):
+    """
+    One of limit.concurrency slots, shared by every process
+    using the same lock directory.
+    """
+
+    def __init__(self, limit, lock_dir):
+        self._limit = limit
+        self._lock_dir = lock_dir
+        self._fd = None
+
+    def __enter__(self):
+        count = self._limit.concurrency if self._limit else None
+        if not count:
+            return self
+        os.makedirs(self._lock_dir, mode=0o700, exist_ok=True)
+        fds = [os.open(os.path.join(self._lock_dir, 'io-slot-%d' % i),
+                       os.O_RDWR | os.O_CREAT, 0o600)
+               for i in range(count)]
+        try:
+            for fd in fds:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                self._fd = fd
+                return self
+            # All taken; wait on the slot of our pid
+            fd = fds[os.getpid() % count]
+            with metrics.timer('io.slot_wait_seconds'):
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            self._fd = fd
+            return self
+        finally:
+            for fd in fds:
+                if fd != self._fd:
+                    os.close(fd)
+
+    def __exit__(self, *exc_info):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def set_idle_priority():
+    """
+    Put the calling process in the idle I/O scheduling class.
+
+    Meant as a subprocess preexec_fn; does nothing where
+    ioprio_set isn't known.
+    """
+
+    number = SYS_IOPRIO_SET.get(platform.machine())
+    if number is None:
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.syscall(number, IOPRIO_WHO_PROCESS, 0,
+                 IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+
+
+def subprocess_kwargs(limit):
+    if limit is not None and limit.idle:
+        return dict(preexec_fn=set_idle_priority)
+    return {}
+
+
+def rsync_options(limit):
+    if limit is not None and limit.rate:
+        # rsync counts in KiB
+        return ['--bwlimit=%d' % max(1, limit.rate // 1024)]
+    return []
+
+
+def copy_file(src, dst, limit=None, follow_symlinks=True):
+    """shutil.copy2, with the copy going through limit's token bucket."""
+
+    if limit is None or limit.bucket is None or os.path.islink(src):
+        return shutil.copy2(src, dst, follow_symlinks=follow_symlinks)
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        while True:
+            data = fsrc.read(COPY_CHUNK)
+            if not data:
+                break
+            limit.bucket.consume(len(data))
+            fdst.write(data)
+            metrics.add('io.copied_bytes', len(data))
+    shutil.copystat(src, dst, follow_symlinks=follow_symlinks)
+    return dst
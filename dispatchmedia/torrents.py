@@ -1,11 +1,15 @@
 # Copyright 2010 Quantique. Licence: GPL3+
 
 
+from array import array
 import contextlib
 import errno
 import hashlib
 import logging
 import os.path
+import sys
+
+from .common import memoized_property
 
 LOGGER = logging.getLogger(__name__)
 
@@ -67,6 +71,61 @@ class LibtorrentResume(object):
             raise TorrentFileError('No bitfield')
 
 
+class FileTable(object):
+    """
+    Compact file list of a multi-file torrent.
+
+    Lengths are kept in an array. Directories are tuples of interned
+    components, stored once and referenced by index. File names are
+    slices of a single decoded string.
+    """
+
+    __slots__ = ('lengths', 'dirs', '_dir_ids', '_names', '_name_ends',
+                 '_pads')
+
+    def __init__(self, finfos, decode_path):
+        self.lengths = array('Q')
+        self.dirs = []
+        self._dir_ids = array('I')
+        self._name_ends = array('Q')
+        self._pads = set()
+        dir_index = {}
+        names = []
+        name_end = 0
+
+        for (index, finfo) in enumerate(finfos):
+            self.lengths.append(finfo['length'])
+            path = decode_path(finfo)
+            if not path:
+                raise TorrentFileError('Empty path in file list')
+            dir_path = tuple(sys.intern(elem) for elem in path[:-1])
+            dir_id = dir_index.get(dir_path)
+            if dir_id is None:
+                dir_id = dir_index[dir_path] = len(self.dirs)
+                self.dirs.append(dir_path)
+            self._dir_ids.append(dir_id)
+            names.append(path[-1])
+            name_end += len(path[-1])
+            self._name_ends.append(name_end)
+            # BEP 47 padding files
+            if b'p' in finfo.get('attr', b''):
+                self._pads.add(index)
+        self._names = ''.join(names)
+
+    def is_pad(self, index):
+        return index in self._pads
+
+    def __iter__(self):
+        """Yield (dir_id, name, length) for each file."""
+
+        names = self._names
+        start = 0
+        for (dir_id, end, length) in zip(
+                self._dir_ids, self._name_ends, self.lengths):
+            yield dir_id, names[start:end], length
+            start = end
+
+
 class TorrentData(object):
     # Adapter pattern
     # BData with an info dict
@@ -88,7 +147,7 @@ class TorrentData(object):
     def _meta_inf(self):
         return self._tdata['info']
 
-    @property
+    @memoized_property
     def info_hash(self):
         # Wasteful but convenient
         return hashlib.sha1(bencode(self._meta_inf)).hexdigest()
@@ -121,6 +180,16 @@ class TorrentData(object):
         return self._meta_inf['piece length']
 
     @property
+    def pieces(self):
+        # Concatenated SHA1 digests, one per piece
+        return self._meta_inf['pieces']
+
+    @property
+    def length(self):
+        # Single-file torrents only
+        return self._meta_inf['length']
+
+    @memoized_property
     def is_multi(self):
         return 'files' in self._meta_inf
 
@@ -135,11 +204,29 @@ class TorrentData(object):
         else:
             return [elem.decode(self.encoding) for elem in finfo['path']]
 
+    @memoized_property
+    def file_table(self):
+        return FileTable(self.multi_finfo, self.multi_finfo_path)
+
+    def compact(self):
+        """
+        Swap the bdecoded file list for the file table.
+
+        The info hash needs the full info dict, so it is computed first.
+        """
+
+        if self.is_multi and 'files' in self._meta_inf:
+            self.file_table
+            self.info_hash
+            del self._meta_inf['files']
+
     def torrent_files(self):
         if self.is_multi:
-            for finfo in self.multi_finfo:
-                path = os.path.join(self.name, *self.multi_finfo_path(finfo))
-                yield path, finfo['length']
+            table = self.file_table
+            dir_prefixes = [
+                os.path.join(self.name, *dir_path) for dir_path in table.dirs]
+            for (dir_id, name, length) in table:
+                yield os.path.join(dir_prefixes[dir_id], name), length
         else:
             path = self.name
             finfo = self._meta_inf
@@ -179,7 +266,7 @@ def from_filehandle(fhandle):
 
 def from_filename(fname):
     try:
-        with open(fname) as fhandle:
+        with open(fname, 'rb') as fhandle:
             return from_filehandle(fhandle)
     except IOError as e:
         if e.errno == errno.ENOENT:
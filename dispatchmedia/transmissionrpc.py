@@ -0,0 +1,88 @@
+# Copyright 2010 Quantique. Licence: GPL3+
+
+"""
+Talk to the Transmission daemon over its HTTP JSON-RPC.
+
+See the spec at:
+    https://github.com/transmission/transmission/blob/main/docs/rpc-spec.md
+"""
+
+__all__ = ('TransmissionRPC', 'RPCError')
+
+import base64
+import http.client
+import json
+import logging
+import urllib.parse
+
+LOGGER = logging.getLogger(__name__)
+
+SESSION_HEADER = 'X-Transmission-Session-Id'
+
+
+class RPCError(Exception):
+    pass
+
+
+class TransmissionRPC(object):
+    """
+    A keep-alive connection to a Transmission RPC endpoint.
+
+    The session id handshake (HTTP 409) is handled transparently,
+    as is reconnecting after the daemon closes the connection.
+    """
+
+    def __init__(self, url, username=None, password=None):
+        us = urllib.parse.urlsplit(url)
+        if us.scheme == 'http':
+            conn_class = http.client.HTTPConnection
+        elif us.scheme == 'https':
+            conn_class = http.client.HTTPSConnection
+        else:
+            raise ValueError(url)
+        self._conn = conn_class(us.hostname, us.port)
+        self._path = us.path or '/transmission/rpc'
+        self._session_id = None
+        self._headers = {'Content-Type': 'application/json'}
+        if username is None:
+            username, password = us.username, us.password
+        if username is not None:
+            creds = '%s:%s' % (username, password or '')
+            self._headers['Authorization'] = (
+                'Basic ' + base64.b64encode(creds.encode()).decode())
+
+    def _post(self, body):
+        headers = dict(self._headers)
+        if self._session_id is not None:
+            headers[SESSION_HEADER] = self._session_id
+        try:
+            self._conn.request('POST', self._path, body, headers)
+            resp = self._conn.getresponse()
+        except (http.client.RemoteDisconnected, BrokenPipeError,
+                ConnectionResetError):
+            # The daemon dropped the idle connection; retry once
+            self._conn.close()
+            self._conn.request('POST', self._path, body, headers)
+            resp = self._conn.getresponse()
+        return resp, resp.read()
+
+    def call(self, method, **arguments):
+        body = json.dumps(dict(method=method, arguments=arguments)).encode()
+        resp, data = self._post(body)
+        if resp.status == 409:
+            # CSRF protection; the reply carries the id to use
+            self._session_id = resp.getheader(SESSION_HEADER)
+            LOGGER.debug('New Transmission session id %s', self._session_id)
+            resp, data = self._post(body)
+        if resp.status != 200:
+            raise RPCError(resp.status, resp.reason, method)
+        reply = json.loads(data.decode('utf-8'))
+        if reply.get('result') != 'success':
+            raise RPCError(reply.get('result'), method)
+        return reply['arguments']
+
+    def torrent_get(self, fields):
+        return self.call('torrent-get', fields=list(fields))['torrents']
+
+    def close(self):
+        self._conn.close()
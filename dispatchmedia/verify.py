@@ -0,0 +1,228 @@
+# Copyright 2010 Quantique. Licence: GPL3+
+
+"""
+Check downloaded torrent payloads against the piece hashes.
+
+Files are read with mmap, in piece-aligned chunks spread across
+a process pool. Files that pass are remembered in a cache keyed by
+info hash and path, and are skipped until their inode, size or
+mtime changes.
+"""
+
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import os
+import os.path
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+HASH_LEN = 20
+# Pieces handed to a worker at a time
+PIECES_PER_TASK = 64
+
+
+def payload_layout(tdata, down_loc):
+    """
+    List (path, offset, length) for every file of the payload.
+
+    Offsets are in the concatenated payload that pieces are cut from.
+    BEP 47 padding files aren't on disk; their path is None.
+    """
+
+    if not tdata.is_multi:
+        return [(down_loc, 0, tdata.length)]
+
+    table = tdata.file_table
+    dir_paths = [os.path.join(down_loc, *dir_path) for dir_path in table.dirs]
+    layout = []
+    offset = 0
+    for (index, (dir_id, name, length)) in enumerate(table):
+        if table.is_pad(index):
+            path = None
+        else:
+            path = os.path.join(dir_paths[dir_id], name)
+        layout.append((path, offset, length))
+        offset += length
+    return layout
+
+
+def stat_key(st):
+    return ('%d:%d:%d' % (st.st_ino, st.st_size, st.st_mtime_ns)).encode()
+
+
+# Worker side.
+# The layout is sent once per worker through the pool initializer.
+_layout = None
+_piece_length = None
+
+
+def _init_worker(layout, piece_length):
+    global _layout, _piece_length
+    _layout = layout
+    _piece_length = piece_length
+
+
+def _hash_pieces(task):
+    """
+    Hash a run of consecutive pieces.
+
+    Returns the index of the first bad piece, or None.
+    """
+
+    first, digests = task
+    start = first * _piece_length
+    end = start + len(digests) // HASH_LEN * _piece_length
+    maps = []
+    try:
+        # Map every file the run overlaps, in payload order
+        for (path, offset, length) in _layout:
+            if offset + length <= start or length == 0:
+                continue
+            if offset >= end:
+                break
+            if path is None:
+                maps.append((offset, length, None))
+                continue
+            with open(path, 'rb') as fhandle:
+                mm = mmap.mmap(fhandle.fileno(), 0, access=mmap.ACCESS_READ)
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+            maps.append((offset, length, mm))
+
+        index = first
+        for pos in range(0, len(digests), HASH_LEN):
+            p_start = index * _piece_length
+            p_end = p_start + _piece_length
+            sha = hashlib.sha1()
+            for (offset, length, mm) in maps:
+                lo = max(p_start, offset)
+                hi = min(p_end, offset + length)
+                if lo >= hi:
+                    continue
+                if mm is None:
+                    sha.update(bytes(hi - lo))
+                else:
+                    sha.update(mm[lo - offset:hi - offset])
+            if sha.digest() != digests[pos:pos + HASH_LEN]:
+                return index
+            index += 1
+        return None
+    finally:
+        for (offset, length, mm) in maps:
+            if mm is not None:
+                mm.close()
+
+
+def verify_payload(tdata, down_loc, cache, processes=None):
+    """
+    Check the payload of tdata, downloaded at down_loc.
+
+    cache is a dbm-like mapping of already verified files.
+    Returns True if every piece matches.
+    """
+
+    layout = payload_layout(tdata, down_loc)
+    piece_length = tdata.piece_length
+    pieces = tdata.pieces
+    info_hash = tdata.info_hash
+    total_length = sum(length for (path, offset, length) in layout)
+    piece_count = len(pieces) // HASH_LEN
+    if piece_count != -(-total_length // piece_length):
+        LOGGER.warning('Piece count doesn\'t match payload size in %s',
+                tdata.name)
+        return False
+
+    # Stat everything up front; a missing or truncated file
+    # fails the torrent without reading a single byte.
+    # The stats taken here are what gets cached, so that a file
+    # rewritten while it is hashed is hashed again next time.
+    file_keys = []
+    file_stats = []
+    cached = []
+    for (path, offset, length) in layout:
+        if path is None:
+            file_keys.append(None)
+            file_stats.append(None)
+            cached.append(True)
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            LOGGER.warning('Missing file %s', path)
+            return False
+        if st.st_size != length:
+            LOGGER.warning('File %s has size %d, expected %d',
+                    path, st.st_size, length)
+            return False
+        key = os.fsencode('%s:%s' % (info_hash, path))
+        file_keys.append(key)
+        file_stats.append(stat_key(st))
+        cached.append(length == 0 or cache.get(key) == stat_key(st))
+
+    # A piece needs hashing unless all files it overlaps are cached
+    todo = bytearray(piece_count)
+    for (is_cached, (path, offset, length)) in zip(cached, layout):
+        if is_cached or length == 0:
+            continue
+        first = offset // piece_length
+        last = (offset + length - 1) // piece_length
+        todo[first:last + 1] = b'\x01' * (last + 1 - first)
+
+    tasks = []
+    index = 0
+    while index < piece_count:
+        if not todo[index]:
+            index += 1
+            continue
+        first = index
+        while (index < piece_count and todo[index]
+               and index - first < PIECES_PER_TASK):
+            index += 1
+        tasks.append(
+            (first, pieces[first * HASH_LEN:index * HASH_LEN]))
+
+    hashed = sum(len(digests) // HASH_LEN for (first, digests) in tasks)
+    bad = None
+    started = time.time()
+    if len(tasks) > 1 and processes != 1:
+        pool = multiprocessing.Pool(processes,
+                initializer=_init_worker, initargs=(layout, piece_length))
+        try:
+            for result in pool.imap(_hash_pieces, tasks):
+                if result is not None:
+                    bad = result
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        _init_worker(layout, piece_length)
+        for task in tasks:
+            bad = _hash_pieces(task)
+            if bad is not None:
+                break
+    elapsed = time.time() - started
+
+    if hashed:
+        LOGGER.info(
+            'Hashed %d of %d pieces of %s in %.1fs (%.1f pieces/s)',
+            hashed, piece_count, tdata.name, elapsed,
+            hashed / max(elapsed, 1e-6))
+
+    # Files entirely before the first bad piece are good
+    if bad is None:
+        good_end = total_length
+    else:
+        good_end = bad * piece_length
+        LOGGER.warning('Piece %d of %s doesn\'t match', bad, tdata.name)
+    for (key, st_key, is_cached, (path, offset, length)) in zip(
+            file_keys, file_stats, cached, layout):
+        if is_cached:
+            continue
+        if offset + length > good_end:
+            break
+        cache[key] = st_key
+
+    return bad is None
@@ -0,0 +1,101 @@
+# Copyright 2010 Quantique. Licence: GPL3+
+
+"""
+Claims on work items, shared by concurrent dispatch-media processes.
+
+Before acting on a release, a process claims it; the claim is taken
+atomically in the state database, so two processes never act on the
+same release at once. Claims of workers that died are taken over:
+on the same host, as soon as the pid is gone; elsewhere, once the
+claim expires.
+
+Workers started together share a run id. Items one of them finished
+aren't picked up again by the others.
+"""
+
+import logging
+import os
+import socket
+import time
+import uuid
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds before a claim from another host can be taken over
+DEFAULT_TTL = 6 * 3600
+# Seconds before finished items are forgotten
+DONE_TTL = 24 * 3600
+
+HOSTNAME = socket.gethostname()
+
+
+def new_run_id():
+    return uuid.uuid4().hex
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class WorkQueue(object):
+    def __init__(self, store, run_id=None, ttl=DEFAULT_TTL):
+        self._store = store
+        self.run_id = run_id or new_run_id()
+        self.ttl = ttl
+        with store.transaction() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS claims ('
+                ' key BLOB PRIMARY KEY, host TEXT, pid INTEGER,'
+                ' expires REAL)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS finished ('
+                ' run TEXT, key BLOB, at REAL, PRIMARY KEY (run, key))')
+            conn.execute('DELETE FROM finished WHERE at < ?',
+                    (time.time() - DONE_TTL, ))
+
+    def _is_live(self, host, pid, expires):
+        if host == HOSTNAME:
+            return pid_alive(pid)
+        return expires > time.time()
+
+    def claim(self, key):
+        """Try to claim key; returns True if this process now owns it."""
+
+        key = os.fsencode(key)
+        pid = os.getpid()
+        with self._store.transaction() as conn:
+            if conn.execute(
+                    'SELECT 1 FROM finished WHERE run = ? AND key = ?',
+                    (self.run_id, key)).fetchone():
+                return False
+            row = conn.execute(
+                'SELECT host, pid, expires FROM claims WHERE key = ?',
+                (key, )).fetchone()
+            if row is not None:
+                host, owner_pid, expires = row
+                if (host, owner_pid) == (HOSTNAME, pid):
+                    return True
+                if self._is_live(host, owner_pid, expires):
+                    return False
+                LOGGER.info('Taking over stale claim on %s from %s:%d',
+                        os.fsdecode(key), host, owner_pid)
+            conn.execute('INSERT OR REPLACE INTO claims VALUES (?, ?, ?, ?)',
+                    (key, HOSTNAME, pid, time.time() + self.ttl))
+        return True
+
+    def release(self, key, finished=True):
+        key = os.fsencode(key)
+        with self._store.transaction() as conn:
+            conn.execute(
+                'DELETE FROM claims WHERE key = ? AND host = ? AND pid = ?',
+                (key, HOSTNAME, os.getpid()))
+            if finished:
+                conn.execute(
+                    'INSERT OR REPLACE INTO finished VALUES (?, ?, ?)',
+                    (self.run_id, key, time.time()))
@@ -43,14 +43,19 @@ Run XMLRPC over SCGI.
 """
 
 
-__all__ = ( 'do_xmlrpc', 'convert_params_to_native', 'RPCError')
+__all__ = ( 'do_xmlrpc', 'do_xmlrpc_iter', 'convert_params_to_native',
+        'RPCError', 'close_transports')
 
 
+import base64
+import contextlib
+import os
 import pipes
 import posixpath
 import re
 import subprocess
 import sys
+import xml.parsers.expat
 try:
     import urllib.parse
     import xmlrpc.client
@@ -101,21 +106,6 @@ def parse_http_headers(headers):
         for line in headers.splitlines())
 
 
-def parse_http(resp):
-    # The response is plain HTTP not wrapped by SCGI,
-    # which is only a request spec.
-    # The headers are the bare xml-rpc requirements, hard-coded by rtorrent.
-    # Always 200 OK; xml-rpc has its own error signaling.
-    headers_str, content = resp.split(b"\r\n\r\n", 1)
-    headers = parse_http_headers(headers_str.decode())
-    clen = int(headers['Content-Length'])
-
-    # Just in case the transport is bogus.
-    assert clen == len(content)
-
-    return content
-
-
 
 ## Socket IO
 SCHEME_TCP = 'tcp'
@@ -126,9 +116,57 @@ urllib.parse.uses_netloc.append(SCHEME_SSH_UNIX)
 
 # POSIX.2 portable
 NETCAT = '/bin/nc'
+SSH = 'ssh'
+REMOTE_PYTHON = 'python3'
+
+# Keep one ssh session per ssh+unix endpoint, see PersistentTransport
+PERSISTENT_SSH = True
+
+# Runs on the remote end of a persistent ssh session.
+# Reads SCGI requests from stdin, forwards each to the rtorrent socket
+# and writes back the reply, prefixed by its length on a line of its own.
+RELAY_SRC = r'''
+import os, socket, sys
+path = os.path.expanduser(sys.argv[1])
+inp, out = sys.stdin.buffer, sys.stdout.buffer
+def read_exactly(n):
+    data = inp.read(n)
+    if len(data) != n:
+        sys.exit(0)
+    return data
+while True:
+    head = b''
+    while not head.endswith(b':'):
+        c = inp.read(1)
+        if not c:
+            sys.exit(0)
+        head += c
+    headers = read_exactly(int(head[:-1]) + 1)
+    fields = headers[:-2].split(b'\0')
+    clen = int(dict(zip(fields[::2], fields[1::2]))[b'CONTENT_LENGTH'])
+    req = head + headers + read_exactly(clen)
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        sock.sendall(req)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        sock.close()
+    except OSError as e:
+        out.write(b'E %s\n' % str(e).encode())
+    else:
+        resp = b''.join(chunks)
+        out.write(b'%d\n' % len(resp))
+        out.write(resp)
+    out.flush()
+'''
 
 
-def cmd_of_endpoint(url):
+def cmd_of_endpoint(url, relay=False):
     """ Parse urls used to reach the rtorrent SCGI socket.
 
         Currently allows unix sockets, local or via ssh, and tcp sockets.
@@ -155,6 +193,9 @@ def cmd_of_endpoint(url):
             Needs firewalling, has poor security.
             tcp://host:port/
 
+        With relay=True, ssh endpoints run RELAY_SRC instead of netcat,
+        which serves any number of requests over the one session.
+
         TODO normal xmlrpc endpoints (no SCGI):
             Needs auth to be secure.
             https://host:port/
@@ -214,38 +255,200 @@ def cmd_of_endpoint(url):
         if reconstructed_netloc != netloc:
             raise ValueError(url)
 
-        cmd = [ 'ssh', '-T' ] + port_flag + [
-            '--', netloc, NETCAT, '-U', '--', clean_path, ]
+        if relay:
+            remote_cmd = [
+                REMOTE_PYTHON, '-c', pipes.quote(RELAY_SRC), clean_path, ]
+            keepalive = [ '-o', 'ServerAliveInterval=30' ]
+        else:
+            remote_cmd = [ NETCAT, '-U', '--', clean_path, ]
+            keepalive = []
+        cmd = [ SSH, '-T' ] + port_flag + keepalive + [
+            '--', ssh_netloc ] + remote_cmd
     else:
         raise ValueError(url)
 
     return cmd
 
 
+class PersistentTransport(object):
+    """ A long-lived ssh session to a relay next to the rtorrent socket.
+
+        Saves an ssh handshake per request. If the session drops,
+        a new one is started on the next request.
+    """
+
+    def __init__(self, endpoint):
+        self.cmd = cmd_of_endpoint(endpoint, relay=True)
+        self._proc = None
+        self._pid = None
+
+    def _start(self):
+        self._proc = subprocess.Popen(
+            self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._pid = os.getpid()
+
+    def close(self, abandoned=False):
+        """ End the session.
+
+            abandoned means a reply wasn't read to the end; the relay
+            may be blocked writing the rest of it, and won't notice
+            stdin closing, so it is killed.
+        """
+
+        # Sessions inherited from a parent process aren't ours to close
+        if self._proc is not None and self._pid == os.getpid():
+            self._proc.stdin.close()
+            if abandoned:
+                self._proc.stdout.close()
+                self._proc.kill()
+            self._proc.wait()
+            if not abandoned:
+                self._proc.stdout.close()
+        self._proc = None
+
+    def request_iter(self, data):
+        """ Send data, then yield the reply in chunks as it arrives.
+
+            If the reply isn't read to the end, the session is closed,
+            since its stream would be out of step.
+        """
+
+        if (self._proc is None or self._pid != os.getpid()
+                or self._proc.poll() is not None):
+            self.close()
+            self._start()
+        try:
+            write_scgi(self._proc.stdin, data)
+        except OSError:
+            # The session dropped while idle; nothing was sent yet.
+            self.close()
+            self._start()
+            write_scgi(self._proc.stdin, data)
+
+        # Past this point the request may have been processed,
+        # so failures aren't retried.
+        header = self._proc.stdout.readline()
+        if not header:
+            self.close()
+            raise RPCError('relay session closed', self.cmd)
+        if header.startswith(b'E '):
+            raise RPCError('relay', header[2:].decode().rstrip(), self.cmd)
+        remaining = int(header)
+        try:
+            while remaining:
+                chunk = self._proc.stdout.read1(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    raise RPCError('relay session closed', self.cmd)
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            if remaining:
+                self.close(abandoned=True)
+
+    def request(self, data):
+        return b''.join(self.request_iter(data))
+
+
+# Idle sessions, by endpoint.
+# A request made while another reply is still being read,
+# as when handling multicall rows as they arrive, gets its own session.
+_TRANSPORTS = {}
+
+
+@contextlib.contextmanager
+def persistent_transport(endpoint):
+    idle = _TRANSPORTS.setdefault(endpoint, [])
+    if idle:
+        transport = idle.pop()
+    else:
+        transport = PersistentTransport(endpoint)
+    try:
+        yield transport
+    finally:
+        idle.append(transport)
+
+
+def close_transports():
+    for idle in _TRANSPORTS.values():
+        for transport in idle:
+            transport.close()
+    _TRANSPORTS.clear()
+
+
 ## Protocol
-def do_transport(endpoint, data):
-    """ Open a transport, send an SCGI request, wait and grab an HTTP reply.
+CHUNK_SIZE = 65536
 
-        TODO: accept HTTP endpoints as well, with none of the SCGI wrapping.
+
+def iter_http_body(chunks):
+    """ Strip the HTTP headers off a stream of chunks.
+
+        The response is plain HTTP not wrapped by SCGI,
+        which is only a request spec.
+        The headers are the bare xml-rpc requirements, hard-coded
+        by rtorrent. Always 200 OK; xml-rpc has its own error signaling.
+        Checks the Content-Length once the stream ends.
+    """
+
+    buf = b''
+    for chunk in chunks:
+        buf += chunk
+        if b"\r\n\r\n" in buf:
+            break
+    else:
+        raise RPCError('truncated headers', buf)
+    headers_str, content = buf.split(b"\r\n\r\n", 1)
+    headers = parse_http_headers(headers_str.decode())
+    clen = int(headers['Content-Length'])
+
+    received = len(content)
+    if content:
+        yield content
+    for chunk in chunks:
+        received += len(chunk)
+        yield chunk
+
+    # Just in case the transport is bogus.
+    if received != clen:
+        raise RPCError('Content-Length mismatch', clen, received)
+
+
+def iter_transport(endpoint, data):
+    """ Send an SCGI request, and yield the HTTP reply body in chunks.
+
+        ssh+unix endpoints reuse a persistent session if PERSISTENT_SSH.
     """
 
+    if PERSISTENT_SSH and endpoint.startswith(SCHEME_SSH_UNIX + ':'):
+        with persistent_transport(endpoint) as transport:
+            for chunk in iter_http_body(transport.request_iter(data)):
+                yield chunk
+        return
+
     cmd = cmd_of_endpoint(endpoint)
     proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    # Can't use communicate:
-    # that would close stdin, send a sighup, netcat would bail.
-    write_scgi(proc.stdin, data)
-    resp_http = proc.stdout.read()
-    proc.stdin.close()
-    proc.wait()
-    proc.stdout.close()
+    try:
+        # Can't use communicate:
+        # that would close stdin, send a sighup, netcat would bail.
+        write_scgi(proc.stdin, data)
+        chunks = iter(lambda: proc.stdout.read1(CHUNK_SIZE), b'')
+        for chunk in iter_http_body(chunks):
+            yield chunk
+    finally:
+        proc.stdin.close()
+        proc.stdout.close()
+        proc.wait()
 
     if proc.returncode:
         raise RPCError('nc', proc.returncode, cmd)
 
-    if not resp_http:
-        raise RPCError('empty', cmd)
 
-    return parse_http(resp_http)
+def do_transport(endpoint, data):
+    """ Open a transport, send an SCGI request, wait and grab an HTTP reply.
+
+        TODO: accept HTTP endpoints as well, with none of the SCGI wrapping.
+    """
+
+    return b''.join(iter_transport(endpoint, data))
 
 
 def do_xmlrpc(endpoint, method, *args):
@@ -273,6 +476,144 @@ def do_xmlrpc(endpoint, method, *args):
     return resp
 
 
+def do_xmlrpc_iter(endpoint, method, *args):
+    """ Send an xmlrpc request whose response is an array,
+        and yield its elements as they come off the transport.
+
+        Meant for multicalls, so rows can be handled before the
+        whole response has arrived, and without holding all of it.
+    """
+
+    req_xml = xmlrpc.client.dumps(args, method)
+    if DEBUG:
+        sys.stderr.write('req_xml: %s\n' % req_xml)
+    decoder = StreamingDecoder()
+    for chunk in iter_transport(endpoint, req_xml):
+        decoder.feed(chunk)
+        for row in decoder.pop_rows():
+            yield row
+    decoder.close()
+    for row in decoder.pop_rows():
+        yield row
+
+
+## Streaming unmarshalling
+def _parse_bool(text):
+    if text not in ('0', '1'):
+        raise ValueError('bad boolean value', text)
+    return text == '1'
+
+
+SCALAR_TYPES = {
+    'string': str,
+    'int': int,
+    'i4': int,
+    'i8': int,
+    'boolean': _parse_bool,
+    'double': float,
+    'dateTime.iso8601': xmlrpc.client.DateTime,
+    'base64': lambda text: base64.decodebytes(text.encode('ascii')),
+    'nil': lambda text: None,
+    }
+
+
+class StreamingDecoder(object):
+    """ Incremental xml-rpc response decoder, built on expat.
+
+        Elements of the top-level array are made available by
+        pop_rows() as soon as their closing tag has been fed.
+        Faults are raised as xmlrpc.client.Fault.
+    """
+
+    def __init__(self):
+        self._parser = xml.parsers.expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._chars
+        # Open arrays and structs
+        self._stack = []
+        # Struct member names, parallel to open structs
+        self._names = []
+        self._text = []
+        self._typed = False
+        self._top = None
+        self._rows = []
+        self._fault = False
+
+    def feed(self, data):
+        self._parser.Parse(data, False)
+
+    def close(self):
+        self._parser.Parse(b'', True)
+        if self._stack:
+            raise RPCError('truncated response')
+
+    def pop_rows(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def _chars(self, text):
+        self._text.append(text)
+
+    def _start(self, tag, attrs):
+        if tag == 'value':
+            self._typed = False
+            self._text = []
+        elif tag in SCALAR_TYPES:
+            self._typed = True
+            self._text = []
+        elif tag == 'array':
+            self._typed = True
+            container = []
+            if self._top is None and not self._fault:
+                # The array the caller iterates over
+                self._top = container
+            self._stack.append(container)
+        elif tag == 'struct':
+            self._typed = True
+            self._stack.append({})
+            self._names.append(None)
+        elif tag == 'name':
+            self._text = []
+        elif tag == 'fault':
+            self._fault = True
+
+    def _end(self, tag):
+        if tag in SCALAR_TYPES:
+            self._value(SCALAR_TYPES[tag](''.join(self._text)))
+        elif tag == 'value':
+            if not self._typed:
+                # Untyped values are strings
+                self._value(''.join(self._text))
+            # Whatever follows, in the enclosing container, is new
+            self._typed = True
+        elif tag == 'array':
+            self._value(self._stack.pop())
+        elif tag == 'struct':
+            self._names.pop()
+            self._value(self._stack.pop())
+        elif tag == 'name':
+            self._names[-1] = ''.join(self._text)
+
+    def _value(self, value):
+        if not self._stack:
+            if self._fault:
+                raise xmlrpc.client.Fault(
+                    value['faultCode'], value['faultString'])
+            if value is not self._top:
+                # Not an array: a single row
+                self._rows.append(value)
+            return
+        container = self._stack[-1]
+        if container is self._top:
+            self._rows.append(value)
+        elif isinstance(container, list):
+            container.append(value)
+        else:
+            container[self._names[-1]] = value
+
+
 POSINT_RE = re.compile(r'^[0-9]+$')
 
 